@@ -0,0 +1,248 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from . import tree
+
+NAME = "bench"
+PASSWORD = "bench"
+# Failed requests are redirected like successful ones unless JSON is asked for.
+JSON = {"Accept": "application/json"}
+
+
+def summarize(samples: list) -> dict:
+    ordered = sorted(samples)
+    return {
+        "iterations": len(samples),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.fmean(ordered),
+        "p95": ordered[min(round(len(ordered) * 0.95), len(ordered) - 1)],
+        "stdev": statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+    }
+
+
+def measure(f, repeat: int, warmup: int = 2, setup=None) -> dict:
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        f()
+
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        f()
+        samples.append(perf_counter() - start)
+    return summarize(samples)
+
+
+def expect(response, status: int):
+    if response.status_code != status:
+        raise RuntimeError(f"{response.request.path}: {response.status_code}")
+    # Bodies are consumed, so that streamed responses are measured in full.
+    response.get_data()
+    response.close()
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure(directory: Path):
+    # The configuration is only read from the working directory or /etc, so
+    # the benchmark runs from within its own temporary directory.
+    with open(directory / "config.ini", "w") as f:
+        f.write(
+            "[filenavi]\n"
+            f"database_uri=sqlite:///{directory / 'filenavi.db'}\n"
+            f"data_dir={directory / 'data'}\n"
+            "users_dir=users\n"
+            "session=cookie\n"
+            "secret_key=bench\n"
+        )
+    os.chdir(directory)
+
+
+def run(args) -> dict:
+    from filenavi import create_app, model, listing
+
+    app = create_app({"TESTING": True})
+    with app.app_context():
+        model.db.create_all()
+        owner = model.User(NAME, PASSWORD, model.Rank.OWNER)
+        model.db.session.add(owner)
+        model.db.session.commit()
+        home = owner.home(model.Visibility.PRIVATE)
+
+    started = perf_counter()
+    listings = tree.generate(home, args.entries, args.depth)
+    tree.payload(home / "download.bin", args.download_size)
+    generated = perf_counter() - started
+
+    client = app.test_client()
+    expect(client.post("/login", data={"name": NAME, "password": PASSWORD}), 302)
+
+    results = {}
+
+    def record(name: str, f, **kwargs):
+        print(f"{name} ...", file=sys.stderr, flush=True)
+        results[name] = measure(f, args.repeat, **kwargs)
+
+    def clear():
+        with app.app_context():
+            listing.cache.clear()
+
+    for entries, relpath in listings.items():
+        url = f"/{NAME}/private/browse/{relpath}/"
+        # Unlimited pages render every entry, which is what large listings
+        # cost without pagination.
+        for limit in [args.page_size, 0]:
+            query = f"?limit={limit}"
+            record(
+                f"browse[entries={entries},limit={limit},cached]",
+                lambda: expect(client.get(url + query), 200),
+            )
+            record(
+                f"browse[entries={entries},limit={limit},uncached]",
+                lambda: expect(client.get(url + query), 200),
+                setup=clear,
+            )
+
+    with app.test_request_context():
+        owner = model.User.query.filter_by(name=NAME).one()
+        deepest = home / listings[max(listings)]
+        record(
+            "user.home",
+            lambda: owner.home(model.Visibility.PRIVATE, listings[max(listings)]),
+        )
+        record(
+            "file.construct",
+            lambda: model.File(deepest, owner, model.Visibility.PRIVATE),
+        )
+
+    uploads = iter(range(sys.maxsize))
+
+    def upload():
+        batch = next(uploads)
+        files = [
+            (io.BytesIO(os.urandom(args.upload_size)), f"upload-{batch}-{i}.bin")
+            for i in range(args.upload_files)
+        ]
+        expect(
+            client.post(
+                f"/{NAME}/private/browse/uploads/",
+                data={"files": files},
+                content_type="multipart/form-data",
+                headers=JSON,
+            ),
+            302,
+        )
+
+    (home / "uploads").mkdir(exist_ok=True)
+    record(f"browse_handler[files={args.upload_files}]", upload)
+
+    url = f"/{NAME}/private/browse/download.bin"
+    record("download", lambda: expect(client.get(url), 200))
+    record(
+        "download[range]",
+        lambda: expect(client.get(url, headers={"Range": "bytes=0-65535"}), 206),
+    )
+
+    # With an offload method set, browse sends files with send_from_directory,
+    # which transfers the whole body as long as X-Sendfile itself is off.
+    app.config["DOWNLOAD_OFFLOAD"] = "x-sendfile"
+    record("send_from_directory", lambda: expect(client.get(url), 200))
+    # The offloaded responses only carry headers, the web server sends the
+    # body.
+    app.config["USE_X_SENDFILE"] = True
+    record("download[x-sendfile]", lambda: expect(client.get(url), 200))
+    app.config["USE_X_SENDFILE"] = False
+    app.config["DOWNLOAD_OFFLOAD"] = "x-accel-redirect"
+    record("download[x-accel-redirect]", lambda: expect(client.get(url), 200))
+    app.config["DOWNLOAD_OFFLOAD"] = None
+
+    record(
+        "login_handler",
+        lambda: expect(
+            client.post(
+                "/login", data={"name": NAME, "password": PASSWORD}, headers=JSON
+            ),
+            302,
+        ),
+    )
+
+    return {
+        "commit": commit(),
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "entries": args.entries,
+            "depth": args.depth,
+            "repeat": args.repeat,
+            "page_size": args.page_size,
+            "upload_files": args.upload_files,
+            "upload_size": args.upload_size,
+            "download_size": args.download_size,
+            "generation": generated,
+        },
+        "results": results,
+    }
+
+
+def sizes(value: str) -> list:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.run",
+        description="Measure the hot paths of filenavi on synthetic user trees.",
+    )
+    parser.add_argument("--entries", type=sizes, default=[100, 10_000, 100_000])
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--upload-files", type=int, default=10)
+    parser.add_argument("--upload-size", type=int, default=64 * 1024)
+    parser.add_argument("--download-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--output", type=Path, default=Path("bench.json"))
+    args = parser.parse_args()
+
+    output = args.output.resolve()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="filenavi-bench-") as directory:
+        configure(Path(directory))
+        try:
+            report = run(args)
+        finally:
+            os.chdir(cwd)
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print(f"Wrote {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
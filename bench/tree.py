@@ -0,0 +1,42 @@
+import os
+from pathlib import Path
+
+
+def populate(directory: Path, entries: int, size: int = 0) -> Path:
+    # Every tenth entry is a directory, the rest are files of the given size,
+    # which is roughly what the listings of real homes look like.
+    directory.mkdir(parents=True, exist_ok=True)
+    data = b"\0" * size
+    for i in range(entries):
+        path = directory / f"entry-{i:06d}"
+        if i % 10 == 0:
+            path.mkdir()
+            continue
+        with open(path.with_suffix(".bin"), "wb") as f:
+            f.write(data)
+    return directory
+
+
+def nest(home: Path, name: str, depth: int) -> Path:
+    path = home / name
+    for level in range(depth):
+        path /= f"level-{level}"
+    return path
+
+
+def generate(home: Path, sizes: list, depth: int) -> dict:
+    # Each listing lives in a directory of its own, nested depth levels below
+    # the home, so that resolving the path is part of what is measured.
+    rv = {}
+    for entries in sizes:
+        directory = nest(home, f"listing-{entries}", depth)
+        populate(directory, entries)
+        rv[entries] = directory.relative_to(home).as_posix()
+    return rv
+
+
+def payload(path: Path, size: int) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return path
@@ -1,12 +1,15 @@
+import os
 from pathlib import Path
 from urllib.parse import urlparse, urlunparse
 from configparser import ConfigParser
 
-from flask import Flask, flash, redirect, url_for, request
+from flask import Flask, flash, redirect, url_for, request, jsonify
 from flask_session import Session
-from humanfriendly import parse_size
+from humanfriendly import parse_size, parse_timespan
 import click
 
+from .upload import Request, Upload
+from .session import LazySessionInterface, connect, secret_key
 from .routing.conv import VisibilityConverter, UserConverter
 from .routing import site, user, storage
 from .routing.error import (
@@ -15,11 +18,15 @@ from .routing.error import (
     AuthenticationFailure,
     MalformedRequest,
     NotAccessible,
+    Conflict,
+    QuotaExceeded,
+    Busy,
 )
 
 
 def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
+    app.request_class = Request
 
     app.config.from_mapping(SQLALCHEMY_TRACK_MODIFICATIONS=False, SESSION_TYPE="redis")
 
@@ -36,6 +43,21 @@ def create_app(test_config=None):
 
     Path(app.instance_path).mkdir(parents=True, exist_ok=True)
 
+    offload = app.config.get("DOWNLOAD_OFFLOAD")
+    if offload not in [None, "x-sendfile", "x-accel-redirect"]:
+        raise ValueError("Invalid download offload method")
+    # X-Accel-Redirect responses are built by the views that need them, as
+    # nginx ignores the X-Sendfile header Flask would add to all others.
+    app.config["USE_X_SENDFILE"] = offload == "x-sendfile"
+
+    # The session, the user cache and the event bus share a single pool.
+    if app.config.get("SESSION_REDIS") is None:
+        app.config["SESSION_REDIS"] = connect(
+            app.config["REDIS_URL"],
+            app.config["REDIS_MAX_CONNECTIONS"],
+            app.config["REDIS_TIMEOUT"],
+        )
+
     @app.context_processor
     def inject():
         return {"model": model}
@@ -43,11 +65,60 @@ def create_app(test_config=None):
     @app.cli.command("init-db")
     def init_db():
         model.db.create_all()
-        owner = model.User("filenavi", "filenavi", model.Rank.OWNER)
-        model.db.session.add(owner)
-        model.db.session.commit()
+        # Running this again only creates the tables that are missing.
+        if model.User.query.first() is None:
+            owner = model.User("filenavi", "filenavi", model.Rank.OWNER)
+            model.db.session.add(owner)
+            model.db.session.commit()
         click.echo("Initialized the database")
 
+    @app.cli.command("upgrade-db")
+    def upgrade_db():
+        model.db.create_all()
+        # Columns and indexes added to existing tables are not created by
+        # create_all.
+        inspector = model.db.inspect(model.db.engine)
+        columns = {c["name"] for c in inspector.get_columns("users")}
+        if "session_epoch" not in columns:
+            with model.db.engine.begin() as connection:
+                connection.execute(
+                    model.db.text(
+                        "ALTER TABLE users"
+                        " ADD COLUMN session_epoch INTEGER NOT NULL DEFAULT 0"
+                    )
+                )
+        for index in model.IndexTrigram.__table__.indexes:
+            index.create(model.db.engine, checkfirst=True)
+        click.echo("Upgraded the database")
+
+    @app.cli.command("rebuild-usage")
+    @click.option("--workers", default=os.cpu_count() or 1, show_default=True)
+    def rebuild_usage(workers):
+        model.Usage.rebuild(workers)
+        click.echo("Rebuilt the usage counters")
+
+    @app.cli.command("reindex")
+    @click.option("--full", is_flag=True, help="Rebuild the index from scratch.")
+    @click.argument("names", nargs=-1)
+    def reindex(full, names):
+        users = model.User.query
+        if names:
+            users = users.filter(model.User.name.in_(names))
+        for u in users.all():
+            for visibility in model.Visibility:
+                model.IndexEntry.rebuild(u, visibility, full=full)
+            click.echo(f"Indexed files of {u.name}")
+
+    @app.cli.command("watch")
+    def watch():
+        from .watcher import Watcher
+
+        if not bus.enabled:
+            raise click.ClickException("Watching is disabled")
+        users = app.config["DATA_DIR"] / app.config["USERS_DIR"]
+        click.echo(f"Watching {users}")
+        Watcher(users.resolve(), bus.publish).run()
+
     app.url_map.converters["user"] = UserConverter
     app.url_map.converters["visibility"] = VisibilityConverter
 
@@ -56,6 +127,9 @@ def create_app(test_config=None):
     app.register_blueprint(storage.bp)
 
     def handle_error(error):
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify(error=error.message), error.code
+
         flash(error.message, "error")
 
         user = model.User.current()
@@ -73,11 +147,41 @@ def create_app(test_config=None):
     app.errorhandler(AuthenticationFailure)(handle_error)
     app.errorhandler(MalformedRequest)(handle_error)
     app.errorhandler(NotAccessible)(handle_error)
+    app.errorhandler(Conflict)(handle_error)
+    app.errorhandler(QuotaExceeded)(handle_error)
+    app.errorhandler(Busy)(handle_error)
 
     from .model import db
+    from .listing import cache
+    from .usercache import cache as user_cache
+    from .jobs import runner
+    from .trash import reaper
+    from .events import bus
+    from .thumbnail import cache as thumbnails
+    from .hashing import hasher
+    from .metrics import metrics
+    from .profiling import profiler
 
     db.init_app(app)
-    sess.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    hasher.init_app(app)
+    cache.init_app(app)
+    user_cache.init_app(app)
+    runner.init_app(app)
+    reaper.init_app(app, purged=model.Usage.release, expire=Upload.reap)
+    bus.init_app(app)
+    thumbnails.init_app(app)
+
+    match app.config["SESSION_BACKEND"]:
+        case "redis":
+            sess.init_app(app)
+        case "cookie":
+            if not app.config.get("SECRET_KEY"):
+                app.secret_key = secret_key(Path(app.instance_path) / "secret_key")
+        case _:
+            raise ValueError("Invalid session backend")
+    app.session_interface = LazySessionInterface(app.session_interface)
 
     return app
 
@@ -114,6 +218,48 @@ def parse_config(app):
         ),
         "USERS_DIR": Path(section.get("users_dir", "users")),
         "MAX_CONTENT_LENGTH": parse_size(section.get("max_content_length", "16MiB")),
+        "LISTING_CACHE_SIZE": section.getint("listing_cache_size", 128),
+        "PAGE_SIZE": section.getint("page_size", 200),
+        "STREAM_LISTINGS": section.getboolean("stream_listings", False),
+        "USER_CACHE": section.get("user_cache"),
+        "USER_CACHE_TTL": section.getint("user_cache_ttl", 60),
+        "USER_CACHE_SIZE": section.getint("user_cache_size", 1024),
+        "UPLOAD_CHUNK_SIZE": parse_size(section.get("upload_chunk_size", "8MiB")),
+        "UPLOAD_MAX_AGE": parse_timespan(section.get("upload_max_age", "1d")),
+        "DOWNLOAD_OFFLOAD": section.get("download_offload"),
+        "ACCEL_REDIRECT_PREFIX": section.get("accel_redirect_prefix", "/internal/"),
+        "JOB_WORKERS": section.getint("job_workers", 0),
+        "QUOTA": parse_size(section["quota"]) if "quota" in section else None,
+        "TRASH": section.getboolean("trash", True),
+        "TRASH_MAX_AGE": parse_timespan(section.get("trash_max_age", "7d")),
+        "TRASH_MAX_SIZE": (
+            parse_size(section["trash_max_size"])
+            if "trash_max_size" in section
+            else None
+        ),
+        "WATCH": section.getboolean("watch", False),
+        "SESSION_BACKEND": section.get("session", "redis"),
+        "SECRET_KEY": section.get("secret_key"),
+        "REDIS_URL": section.get("redis_url", "redis://localhost:6379/0"),
+        "REDIS_MAX_CONNECTIONS": section.getint("redis_max_connections", 32),
+        "REDIS_TIMEOUT": parse_timespan(section.get("redis_timeout", "1s")),
+        "PASSWORD_METHOD": section.get("password_method", "pbkdf2:sha256"),
+        "PASSWORD_WORKERS": section.getint("password_workers", 0),
+        "PASSWORD_BACKLOG": section.getint("password_backlog", 16),
+        "METRICS": section.getboolean("metrics", False),
+        "PROFILING": section.getboolean("profiling", False),
+        "PROFILING_SAMPLE": section.getint("profiling_sample", 0),
+        "PROFILING_KEEP": section.getint("profiling_keep", 100),
+        "PROFILING_DIR": (
+            Path(section["profiling_dir"]) if "profiling_dir" in section else None
+        ),
+        "THUMBNAIL_WORKERS": section.getint("thumbnail_workers", 0),
+        "THUMBNAIL_DIR": (
+            Path(section["thumbnail_dir"]) if "thumbnail_dir" in section else None
+        ),
+        "THUMBNAIL_CACHE_SIZE": parse_size(
+            section.get("thumbnail_cache_size", "256MiB")
+        ),
     }
 
     return rv
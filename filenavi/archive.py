@@ -0,0 +1,279 @@
+import os
+import stat
+import time
+import zlib
+import struct
+import tarfile
+import zipfile
+import tempfile
+from pathlib import Path
+
+BLOCK_SIZE = 256 * 1024
+SPOOL_SIZE = 1024 * 1024
+ZIP64_LIMIT = 1 << 31
+
+FORMATS = {
+    "zip": ("application/zip", ".zip"),
+    "tar.gz": ("application/gzip", ".tar.gz"),
+}
+
+
+class Sink:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        rv = b"".join(self.chunks)
+        self.chunks = []
+        return rv
+
+
+def walk(home: Path, path: Path):
+    # Symbolic links are followed only if they resolve to somewhere inside the
+    # home directory, mirroring the check File performs, and directories are
+    # never entered through a link so that the walk cannot loop.
+    stack = [(path, Path(path.name), path.stat())]
+    while stack:
+        directory, arcdir, st = stack.pop()
+        yield directory, arcdir, st
+
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            continue
+
+        with it:
+            for e in it:
+                p = Path(e.path)
+                if e.is_symlink():
+                    if e.is_dir() or not p.resolve().is_relative_to(home):
+                        continue
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append((p, arcdir / e.name, st))
+                elif stat.S_ISREG(st.st_mode):
+                    yield p, arcdir / e.name, st
+
+
+def read(path: Path, size: int):
+    # Exactly size bytes are produced, even if the file changes while it is
+    # being read, as the size has already been announced in a header.
+    remaining = size
+    try:
+        with open(path, "rb") as f:
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+    except OSError:
+        pass
+    while remaining > 0:
+        block = bytes(min(BLOCK_SIZE, remaining))
+        remaining -= len(block)
+        yield block
+
+
+def dos_time(mtime: float) -> tuple:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((min(t.tm_year, 2107) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+def zip64_extra(*values: int) -> bytes:
+    if not values:
+        return b""
+    return struct.pack(f"<HH{len(values)}Q", 0x0001, 8 * len(values), *values)
+
+
+def stream_zip(home: Path, path: Path, compression: int):
+    # ZipFile keeps every member's ZipInfo until it writes the central
+    # directory, which grows with the tree. The archive is written here
+    # instead, and the central directory records are spooled to a temporary
+    # file as each member is finished, so memory stays the same no matter how
+    # many files there are.
+    directory = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    offset = 0
+    entries = 0
+
+    with directory:
+        for p, arcname, st in walk(home, path):
+            name = arcname.as_posix().encode()
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if is_dir:
+                name += b"/"
+            clock, date = dos_time(st.st_mtime)
+            method = zipfile.ZIP_STORED if is_dir else compression
+            zip64 = not is_dir and st.st_size >= ZIP64_LIMIT
+            version = 45 if zip64 else 20
+            # Sizes and checksums follow the data in a descriptor, as they
+            # are only known once it has been read.
+            flags = 0x800 if is_dir else 0x808
+
+            extra = zip64_extra(0, 0) if zip64 else b""
+            limit = 0xFFFFFFFF if zip64 else 0
+            header = struct.pack(
+                "<IHHHHHIIIHH",
+                0x04034B50,
+                version,
+                flags,
+                method,
+                clock,
+                date,
+                0,
+                limit,
+                limit,
+                len(name),
+                len(extra),
+            )
+            yield header + name + extra
+            start = offset
+            offset += len(header) + len(name) + len(extra)
+
+            crc = 0
+            size = 0
+            compressed = 0
+            if not is_dir:
+                compressor = None
+                if method == zipfile.ZIP_DEFLATED:
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                for block in read(p, st.st_size):
+                    crc = zlib.crc32(block, crc)
+                    size += len(block)
+                    if compressor is not None:
+                        block = compressor.compress(block)
+                    compressed += len(block)
+                    yield block
+                if compressor is not None:
+                    block = compressor.flush()
+                    compressed += len(block)
+                    yield block
+
+                descriptor = struct.pack(
+                    "<IIQQ" if zip64 else "<IIII", 0x08074B50, crc, compressed, size
+                )
+                yield descriptor
+            offset += compressed
+            offset += 0 if is_dir else len(descriptor)
+
+            large = [v for v in (size, compressed, start) if v >= 0xFFFFFFFF]
+            extra = zip64_extra(*large)
+            mode = stat.S_IMODE(st.st_mode) | (stat.S_IFDIR if is_dir else stat.S_IFREG)
+            directory.write(
+                struct.pack(
+                    "<IHHHHHHIIIHHHHHII",
+                    0x02014B50,
+                    (3 << 8) | version,
+                    45 if large else version,
+                    flags,
+                    method,
+                    clock,
+                    date,
+                    crc,
+                    min(compressed, 0xFFFFFFFF),
+                    min(size, 0xFFFFFFFF),
+                    len(name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    (mode << 16) | (0x10 if is_dir else 0),
+                    min(start, 0xFFFFFFFF),
+                )
+                + name
+                + extra
+            )
+            entries += 1
+
+        size = directory.tell()
+        directory.seek(0)
+        while block := directory.read(BLOCK_SIZE):
+            yield block
+
+    end = b""
+    if entries >= 0xFFFF or size >= 0xFFFFFFFF or offset >= 0xFFFFFFFF:
+        end += struct.pack(
+            "<IQHHIIQQQQ", 0x06064B50, 44, (3 << 8) | 45, 45, 0, 0,
+            entries, entries, size, offset,
+        )
+        end += struct.pack("<IIQI", 0x07064B50, 0, offset + size, 1)
+    end += struct.pack(
+        "<IHHHHIIH",
+        0x06054B50,
+        0,
+        0,
+        min(entries, 0xFFFF),
+        min(entries, 0xFFFF),
+        min(size, 0xFFFFFFFF),
+        min(offset, 0xFFFFFFFF),
+        0,
+    )
+    yield end
+
+
+def stream_tar(home: Path, path: Path):
+    sink = Sink()
+    tar = tarfile.open(fileobj=sink, mode="w|gz", format=tarfile.PAX_FORMAT)
+    try:
+        for p, arcname, st in walk(home, path):
+            info = tarfile.TarInfo(arcname.as_posix())
+            info.mode = stat.S_IMODE(st.st_mode)
+            info.mtime = int(st.st_mtime)
+            if stat.S_ISDIR(st.st_mode):
+                info.type = tarfile.DIRTYPE
+            else:
+                info.size = st.st_size
+
+            # TarFile.addfile would copy the whole member in one call, so the
+            # header and data are written to the compressed stream here
+            # instead, draining the output after every block. Members are not
+            # remembered, which keeps memory independent of the tree.
+            header = info.tobuf(tar.format, tar.encoding, tar.errors)
+            tar.fileobj.write(header)
+            tar.offset += len(header)
+            if info.isfile():
+                for block in read(p, info.size):
+                    tar.fileobj.write(block)
+                    yield sink.drain()
+                blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+                if remainder > 0:
+                    tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                    blocks += 1
+                tar.offset += blocks * tarfile.BLOCKSIZE
+            yield sink.drain()
+    finally:
+        tar.close()
+    yield sink.drain()
+
+
+def stream(home: Path, path: Path, format: str, compression: str = "store"):
+    if format == "zip":
+        if compression not in ["store", "deflate"]:
+            raise ValueError("Invalid compression")
+        chunks = stream_zip(
+            home,
+            path,
+            zipfile.ZIP_DEFLATED if compression == "deflate" else zipfile.ZIP_STORED,
+        )
+    elif format == "tar.gz":
+        chunks = stream_tar(home, path)
+    else:
+        raise ValueError("Invalid archive format")
+
+    return (chunk for chunk in chunks if chunk)
@@ -0,0 +1,97 @@
+from os import scandir
+from bisect import bisect_left
+from pathlib import Path
+from threading import Lock
+from time import time
+
+
+class Node:
+    __slots__ = ("validator", "children", "names")
+
+    def __init__(self):
+        self.validator = None
+        self.children = None
+        # Sorted (casefolded name, name) pairs, for prefix lookups by bisection.
+        self.names = None
+
+
+def scan_directories(path: Path) -> list:
+    with scandir(path) as it:
+        return [
+            e.name
+            for e in it
+            if e.is_dir(follow_symlinks=False) and not e.name.endswith(".filenavi-part")
+        ]
+
+
+class DirectoryTree:
+    def __init__(self, home: Path):
+        self.home = home
+        self.root = Node()
+        self.lock = Lock()
+
+    def refresh(self, node: Node, path: Path):
+        stat = path.stat()
+        validator = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        if node.children is not None and node.validator == validator:
+            return
+
+        names = scan_directories(path)
+
+        # Only the directories that are gone are dropped, so that the subtrees
+        # that were loaded before stay cached.
+        with self.lock:
+            old = node.children or {}
+            node.children = {n: old.get(n) or Node() for n in names}
+            node.names = sorted((n.casefold(), n) for n in names)
+            # Like listings, directories modified within the timestamp
+            # granularity are scanned again on the next lookup.
+            node.validator = validator if time() - stat.st_mtime >= 1 else None
+
+    def complete(self, prefix: str, limit: int) -> list:
+        *parents, partial = prefix.lstrip("/").split("/")
+
+        node = self.root
+        path = self.home
+        for name in parents:
+            if name in ["", ".", ".."]:
+                return []
+            self.refresh(node, path)
+            node = node.children.get(name)
+            if node is None:
+                return []
+            path = path / name
+        self.refresh(node, path)
+
+        base = "".join(f"{name}/" for name in parents)
+        folded = partial.casefold()
+        names = node.names
+        rv = []
+        for i in range(bisect_left(names, (folded,)), len(names)):
+            if len(rv) >= limit or not names[i][0].startswith(folded):
+                break
+            rv.append(base + names[i][1])
+        return rv
+
+
+class CompletionCache:
+    def __init__(self):
+        self.trees = {}
+        self.lock = Lock()
+
+    def complete(
+        self, owner, visibility, home: Path, prefix: str, limit: int = 20
+    ) -> list:
+        key = (owner.id, visibility)
+        with self.lock:
+            tree = self.trees.get(key)
+            if tree is None or tree.home != home:
+                tree = self.trees[key] = DirectoryTree(home)
+
+        try:
+            return tree.complete(prefix, limit)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+
+cache = CompletionCache()
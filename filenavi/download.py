@@ -0,0 +1,185 @@
+import secrets
+import mimetypes
+import unicodedata
+from urllib.parse import quote
+
+from flask import request, Response
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+
+from . import model
+
+BLOCK_SIZE = 256 * 1024
+MAX_RANGES = 32
+
+
+def etag(file: model.File) -> str:
+    attributes = file.attributes
+    mtime = int(attributes["modification"].timestamp() * 1_000_000)
+    return f"{attributes['inode']:x}-{attributes['size']:x}-{mtime:x}"
+
+
+def disposition(name: str, as_attachment: bool) -> dict:
+    kind = "attachment" if as_attachment else "inline"
+    try:
+        name.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", name).encode("ascii", "ignore")
+        return {
+            "_value": kind,
+            "filename": simple.decode("ascii"),
+            "filename*": f"UTF-8''{quote(name, safe='!#$&+^`|')}",
+        }
+    return {"_value": kind, "filename": name}
+
+
+def parse_ranges(header: str):
+    # Werkzeug refuses range sets that are unordered or overlapping, which
+    # clients do send, so the header is parsed here and normalized below.
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes":
+        return None
+
+    rv = []
+    for item in spec.split(","):
+        start, sep, stop = item.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if start == "":
+                if int(stop) > 0:
+                    rv.append((-int(stop), None))
+            else:
+                start = int(start)
+                stop = int(stop) + 1 if stop != "" else None
+                if start < 0 or (stop is not None and stop <= start):
+                    return None
+                rv.append((start, stop))
+        except ValueError:
+            return None
+    return rv
+
+
+def satisfiable(ranges, size: int) -> list:
+    rv = []
+    for start, stop in ranges:
+        if stop is None and start < 0:
+            start = max(size + start, 0)
+            stop = size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            rv.append([start, stop])
+
+    # Overlapping and adjacent ranges are merged so that a client cannot
+    # request the same bytes many times over.
+    rv.sort()
+    merged = []
+    for start, stop in rv:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def read(path, ranges, parts=None):
+    # The file is only opened once the body is iterated, which never
+    # happens for HEAD requests or bodiless responses.
+    with open(path, "rb") as f:
+        for i, (start, stop) in enumerate(ranges):
+            if parts is not None:
+                yield parts[i]
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    return
+                remaining -= len(block)
+                yield block
+        if parts is not None:
+            yield parts[-1]
+
+
+def redirect(file: model.File, location: str, as_attachment: bool = True):
+    # nginx serves the file at the internal location in place of this body,
+    # and answers ranges and conditional requests on its own.
+    mimetype = mimetypes.guess_type(file.path.name)[0] or "application/octet-stream"
+    rv = Response(mimetype=mimetype)
+    rv.cache_control.no_cache = True
+    rv.headers.set(
+        "Content-Disposition", **disposition(file.path.name, as_attachment)
+    )
+    rv.headers["X-Accel-Redirect"] = location
+    return rv
+
+
+def send(file: model.File, as_attachment: bool = True) -> Response:
+    size = file.attributes["size"]
+    modification = file.attributes["modification"].replace(microsecond=0)
+    tag = etag(file)
+    mimetype = mimetypes.guess_type(file.path.name)[0] or "application/octet-stream"
+
+    rv = Response(mimetype=mimetype, direct_passthrough=True)
+    rv.set_etag(tag)
+    rv.last_modified = modification
+    rv.cache_control.no_cache = True
+    rv.accept_ranges = "bytes"
+    rv.headers.set(
+        "Content-Disposition", **disposition(file.path.name, as_attachment)
+    )
+
+    if not is_resource_modified(
+        request.environ, etag=tag, last_modified=modification
+    ):
+        rv.status_code = 304
+        del rv.content_type
+        return rv
+
+    ranges = None
+    if "Range" in request.headers:
+        ranges = parse_ranges(request.headers["Range"])
+        if_range = request.if_range
+        if if_range.etag is not None and if_range.etag != tag:
+            ranges = None
+        elif if_range.date is not None and if_range.date != modification:
+            ranges = None
+
+    if ranges is None or len(ranges) > MAX_RANGES:
+        rv.content_length = size
+        if request.method == "HEAD":
+            return rv
+        rv.response = wrap_file(request.environ, open(file.path, "rb"), BLOCK_SIZE)
+        return rv
+
+    ranges = satisfiable(ranges, size)
+    if not ranges:
+        rv.status_code = 416
+        rv.headers["Content-Range"] = f"bytes */{size}"
+        rv.content_length = 0
+        return rv
+
+    rv.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        rv.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        rv.content_length = stop - start
+        rv.response = read(file.path, ranges)
+        return rv
+
+    boundary = secrets.token_hex(16)
+    parts = [
+        (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+        ).encode()
+        for start, stop in ranges
+    ]
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+
+    rv.content_type = f"multipart/byteranges; boundary={boundary}"
+    rv.content_length = sum(map(len, parts)) + sum(b - a for a, b in ranges)
+    rv.response = read(file.path, ranges, parts)
+    return rv
@@ -0,0 +1,112 @@
+import json
+import time
+from queue import Queue, Full
+from threading import Thread, Lock
+from contextlib import contextmanager
+
+from . import listing, model
+
+CHANNEL = "filenavi:events"
+QUEUE_SIZE = 64
+
+
+class EventBus:
+    def __init__(self):
+        self.app = None
+        self.redis = None
+        self.thread = None
+        self.lock = Lock()
+        self.listeners = {}
+
+    def init_app(self, app):
+        self.app = app
+        if not app.config.get("WATCH", False):
+            return
+
+        redis = app.config.get("SESSION_REDIS")
+        if redis is None:
+            from redis import Redis
+
+            redis = Redis()
+        self.redis = redis
+        app.before_request(self.start)
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None
+
+    def publish(self, events: list):
+        self.redis.publish(CHANNEL, json.dumps(events))
+
+    def start(self):
+        # Like the trash reaper, the subscriber is started by the first
+        # request so that it runs in every worker.
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self.run, name="filenavi-events", daemon=True
+                )
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                for message in pubsub.listen():
+                    self.dispatch(json.loads(message["data"]))
+            except Exception:
+                self.app.logger.exception("Lost the event subscription")
+                time.sleep(1)
+
+    def dispatch(self, events: list):
+        keys = {}
+        notify = []
+        for event in events:
+            if event.get("reset"):
+                listing.cache.clear()
+                notify = [(k, event) for k in list(self.listeners)]
+                break
+
+            visibility = model.Visibility[event["visibility"]]
+            keys[event["user"], visibility, event["path"]] = event["recursive"]
+
+            prefix = "" if event["path"] == "." else f"{event['path']}/"
+            for key in list(self.listeners):
+                user_id, v, path = key
+                if user_id != event["user"] or v != event["visibility"]:
+                    continue
+                if path == event["path"] or (
+                    event["recursive"] and path.startswith(prefix)
+                ):
+                    notify.append((key, event))
+
+        # The keys have the same shape as those of ListingCache.key.
+        listing.cache.drop(keys)
+
+        with self.lock:
+            for key, event in notify:
+                for queue in self.listeners.get(key, []):
+                    try:
+                        queue.put_nowait(event)
+                    except Full:
+                        pass
+
+    @contextmanager
+    def listen(self, owner, visibility, relpath: str):
+        key = (owner.id, visibility.name, relpath)
+        queue = Queue(QUEUE_SIZE)
+        with self.lock:
+            self.listeners.setdefault(key, []).append(queue)
+        try:
+            yield queue
+        finally:
+            with self.lock:
+                self.listeners[key].remove(queue)
+                if not self.listeners[key]:
+                    del self.listeners[key]
+
+
+bus = EventBus()
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from werkzeug.security import (
+    generate_password_hash,
+    check_password_hash,
+    DEFAULT_PBKDF2_ITERATIONS,
+)
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.method = f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}"
+        self.workers = 0
+        self.backlog = 0
+        self.pending = 0
+        self.executor = None
+        self.lock = Lock()
+
+    def init_app(self, app):
+        method = app.config.get("PASSWORD_METHOD", self.method)
+        # Stored hashes always name their iterations, so the configured method
+        # does too in order to tell whether a hash is outdated.
+        if method.startswith("pbkdf2:") and method.count(":") == 1:
+            method = f"{method}:{DEFAULT_PBKDF2_ITERATIONS}"
+        self.method = method
+        self.workers = app.config.get("PASSWORD_WORKERS", 0)
+        self.backlog = app.config.get("PASSWORD_BACKLOG", 0)
+
+    def hash(self, password: str) -> str:
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify(self, hashed: str, password: str) -> bool:
+        return self.run(check_password_hash, hashed, password)
+
+    def outdated(self, hashed: str) -> bool:
+        return hashed.split("$", 1)[0] != self.method
+
+    def run(self, f, *args):
+        if self.workers <= 0:
+            return f(*args)
+
+        # Hashes beyond the ones being computed and the backlog are turned
+        # away right away, so that a burst of logins cannot tie up every
+        # thread of a worker that also has files to serve.
+        with self.lock:
+            if self.pending >= self.workers + self.backlog:
+                from .routing.error import Busy
+
+                raise Busy
+            self.pending += 1
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="filenavi-hash"
+                )
+
+        try:
+            return self.executor.submit(f, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,200 @@
+import os
+from pathlib import Path
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+from time import monotonic, sleep
+
+from . import model
+
+RETENTION = timedelta(days=7)
+HEARTBEAT_INTERVAL = 60
+# A job that has not been touched for this long was queued by a worker that
+# exited before finishing it.
+STALE = timedelta(minutes=5)
+
+
+def device(path: Path) -> int:
+    # The destination of a move usually does not exist yet, so the device is
+    # taken from the nearest ancestor that does.
+    for p in [path, *path.parents]:
+        try:
+            return os.stat(p).st_dev
+        except OSError:
+            continue
+
+
+def heavy(source: Path, destination: Path = None) -> bool:
+    if not source.exists() and not source.is_symlink():
+        return False
+    if destination is None:
+        return source.is_dir() and not source.is_symlink()
+    return source.lstat().st_dev != device(destination)
+
+
+class Progress:
+    def __init__(self, job: model.Job, interval: float = 1.0):
+        self.job = job
+        self.interval = interval
+        self.size = 0
+        self.entries = 0
+        self.flushed = monotonic()
+
+    def __call__(self, size: int = 0, entries: int = 0):
+        self.size += size
+        self.entries += entries
+        if monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.job.processed_size = self.size
+        self.job.processed_entries = self.entries
+        self.job.updated = datetime.utcnow()
+        model.db.session.commit()
+        self.flushed = monotonic()
+
+
+def execute(job: model.Job, progress: Progress):
+    owner = job.owner
+    target = model.File(Path(job.path), owner, job.visibility)
+
+    match job.kind:
+        case model.JobKind.MOVE:
+            target.move(
+                owner.home(job.visibility, job.destination),
+                force=job.force,
+                progress=progress,
+            )
+        case model.JobKind.TOGGLE:
+            target.toggle(Path(job.destination), force=job.force, progress=progress)
+        case model.JobKind.REMOVE:
+            target.remove(recursive=job.force, progress=progress)
+        case _:
+            raise ValueError("Invalid job")
+
+
+class JobRunner:
+    def __init__(self):
+        self.app = None
+        self.workers = 0
+        self.executor = None
+        self.thread = None
+        self.pending = set()
+        self.lock = Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get("JOB_WORKERS", 0)
+        if self.enabled:
+            app.before_request(self.start)
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def start(self):
+        # Like the reaper, this runs in every worker, so that jobs lost with
+        # a worker are noticed even if no other job is ever submitted.
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self.heartbeat, name="filenavi-jobs", daemon=True
+                )
+                self.thread.start()
+
+    def heartbeat(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.touch()
+                    self.recover()
+                except Exception:
+                    model.db.session.rollback()
+                    self.app.logger.exception("Unable to check jobs")
+            sleep(HEARTBEAT_INTERVAL)
+
+    def touch(self):
+        # Progress is only recorded between files, so the jobs of this worker
+        # are kept fresh here while they wait or copy a large file.
+        with self.lock:
+            pending = list(self.pending)
+        if pending:
+            model.Job.query.filter(
+                model.Job.id.in_(pending),
+                model.Job.state.in_([model.JobState.QUEUED, model.JobState.RUNNING]),
+            ).update({"updated": datetime.utcnow()}, synchronize_session=False)
+            model.db.session.commit()
+
+    def recover(self):
+        model.Job.query.filter(
+            model.Job.state.in_([model.JobState.QUEUED, model.JobState.RUNNING]),
+            model.Job.updated < datetime.utcnow() - STALE,
+        ).update(
+            {
+                "state": model.JobState.FAILED,
+                "message": "Interrupted",
+                "updated": datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        model.db.session.commit()
+
+    def submit(self, job: model.Job) -> model.Job:
+        model.Job.query.filter(
+            model.Job.state.in_([model.JobState.DONE, model.JobState.FAILED]),
+            model.Job.updated < datetime.utcnow() - RETENTION,
+        ).delete(synchronize_session=False)
+
+        model.db.session.add(job)
+        model.db.session.commit()
+
+        # The pool is started on first use rather than in init_app, so that
+        # it is never created in a process that forks into workers later.
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="filenavi-job"
+                )
+            self.pending.add(job.id)
+        self.executor.submit(self.run, job.id)
+
+        return job
+
+    def run(self, id: int):
+        try:
+            self.process(id)
+        finally:
+            with self.lock:
+                self.pending.discard(id)
+
+    def process(self, id: int):
+        with self.app.app_context():
+            job = model.Job.query.get(id)
+            if job is None or job.state.finished:
+                return
+
+            job.state = model.JobState.RUNNING
+            job.updated = datetime.utcnow()
+            model.db.session.commit()
+
+            progress = Progress(job)
+            try:
+                execute(job, progress)
+            except Exception as e:
+                model.db.session.rollback()
+                if isinstance(e, OSError):
+                    job.message = e.strerror or "Operation failed"
+                elif isinstance(e, ValueError):
+                    job.message = str(e)
+                else:
+                    self.app.logger.exception("Job %d failed", id)
+                    job.message = "Operation failed"
+                job.state = model.JobState.FAILED
+            else:
+                job.state = model.JobState.DONE
+            progress.flush()
+
+
+runner = JobRunner()
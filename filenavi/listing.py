@@ -0,0 +1,249 @@
+from os import scandir
+from stat import S_ISDIR
+from pathlib import Path
+from datetime import datetime, timezone
+from collections import OrderedDict
+from threading import Lock, local
+from contextlib import contextmanager
+from time import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import heapq
+import json
+import re
+
+from .metrics import metrics
+
+
+class Entry:
+    __slots__ = ("name", "is_dir", "is_symlink", "size", "mtime", "relpath")
+
+    def __init__(
+        self,
+        name: str,
+        is_dir: bool,
+        is_symlink: bool,
+        size: int,
+        mtime: float,
+        relpath: str,
+    ):
+        self.name = name
+        self.is_dir = is_dir
+        self.is_symlink = is_symlink
+        self.size = size
+        self.mtime = mtime
+        self.relpath = relpath
+
+    @property
+    def modification(self) -> datetime:
+        return datetime.fromtimestamp(self.mtime, tz=timezone.utc)
+
+    @property
+    def display_name(self) -> str:
+        return self.name + "/" if self.is_dir else self.name
+
+    @property
+    def extension(self) -> str:
+        return self.name.rpartition(".")[2].lower() if "." in self.name else ""
+
+    @property
+    def url_path(self) -> str:
+        return self.relpath + "/" if self.is_dir else self.relpath
+
+
+def scan(path: Path, home: Path):
+    relative = path.relative_to(home)
+    prefix = "" if relative == Path(".") else f"{relative.as_posix()}/"
+
+    # The directory is opened right away so that errors surface to the
+    # caller instead of in the middle of a streamed response.
+    return _entries(scandir(path), prefix)
+
+
+def stream(path: Path, home: Path):
+    # Entries are only read as the response is sent, so the time spent on
+    # them is added up as they are, on top of opening the directory.
+    with metrics.timed("listing"):
+        files = scan(path, home)
+    return metrics.iterate("listing", files)
+
+
+def _entries(it, prefix: str):
+    # The entry type comes from the dirent itself, so the only syscall per
+    # entry is the stat below (plus an lstat for dangling symlinks).
+    with it:
+        for e in it:
+            is_symlink = e.is_symlink()
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                if not is_symlink:
+                    continue
+                stat = e.stat(follow_symlinks=False)
+
+            yield Entry(
+                e.name,
+                S_ISDIR(stat.st_mode),
+                is_symlink,
+                stat.st_size,
+                stat.st_mtime,
+                prefix + e.name,
+            )
+
+
+def natural_key(name: str) -> tuple:
+    parts = re.split(r"(\d+)", name.casefold())
+    return tuple(int(p) if i % 2 else p for i, p in enumerate(parts)), name
+
+
+SORT_KEYS = {
+    "name": lambda e: natural_key(e.name),
+    "size": lambda e: (e.size, natural_key(e.name)),
+    "mtime": lambda e: (e.mtime, natural_key(e.name)),
+}
+
+
+def encode_cursor(sort: str, entry: Entry) -> str:
+    value = None if sort == "name" else getattr(entry, sort)
+    payload = json.dumps([value, entry.name], separators=(",", ":"))
+    return urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(sort: str, cursor: str) -> tuple:
+    try:
+        payload = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, name = json.loads(payload)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(name, str):
+        raise ValueError("Invalid cursor")
+    if sort == "name":
+        return natural_key(name)
+    if not isinstance(value, (int, float)):
+        raise ValueError("Invalid cursor")
+    return value, natural_key(name)
+
+
+def paginate(
+    entries, sort: str = "name", reverse: bool = False, limit: int = 0, after=None
+):
+    if sort not in SORT_KEYS:
+        raise ValueError("Invalid sort key")
+    key = SORT_KEYS[sort]
+
+    if after is not None:
+        bound = decode_cursor(sort, after)
+        if reverse:
+            entries = (e for e in entries if key(e) < bound)
+        else:
+            entries = (e for e in entries if key(e) > bound)
+
+    if limit <= 0:
+        return sorted(entries, key=key, reverse=reverse), None
+
+    # Only limit + 1 entries are ever held in the heap; the extra one tells
+    # whether another page follows.
+    select = heapq.nlargest if reverse else heapq.nsmallest
+    files = select(limit + 1, entries, key=key)
+    if len(files) <= limit:
+        return files, None
+
+    files = files[:limit]
+    return files, encode_cursor(sort, files[-1])
+
+
+class ListingCache:
+    def __init__(self, size: int = 0):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.local = local()
+
+    def init_app(self, app):
+        self.size = app.config.get("LISTING_CACHE_SIZE", 0)
+
+    @staticmethod
+    def key(owner, visibility, relpath) -> tuple:
+        return (owner.id, visibility, Path(relpath).as_posix())
+
+    def listdir(self, owner, visibility, home: Path, path: Path) -> tuple:
+        with metrics.timed("stat"):
+            stat = path.stat()
+        if self.size <= 0:
+            with metrics.timed("listing"):
+                return tuple(scan(path, home))
+
+        key = self.key(owner, visibility, path.relative_to(home))
+        validator = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+
+        with self.lock:
+            hit = self.entries.get(key)
+            if hit is not None and hit[0] == validator:
+                self.entries.move_to_end(key)
+                return hit[1]
+
+        with metrics.timed("listing"):
+            files = tuple(scan(path, home))
+
+        # A directory modified within the timestamp granularity of the scan
+        # could change again without its mtime moving, so it is not cached.
+        if time() - stat.st_mtime < 1:
+            return files
+
+        with self.lock:
+            self.entries[key] = (validator, files)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return files
+
+    def invalidate(self, owner, visibility, relpath, recursive: bool = False):
+        key = self.key(owner, visibility, relpath)
+        pending = getattr(self.local, "pending", None)
+        if pending is not None:
+            pending[key] = pending.get(key, False) or recursive
+        else:
+            self.drop({key: recursive})
+
+    @contextmanager
+    def deferred(self):
+        # Invalidations made while a batch of files is changed are collected
+        # and applied together, so that the cache is only scanned once.
+        if getattr(self.local, "pending", None) is not None:
+            yield
+            return
+
+        self.local.pending = {}
+        try:
+            yield
+        finally:
+            pending, self.local.pending = self.local.pending, None
+            self.drop(pending)
+
+    def drop(self, keys: dict):
+        prefixes = [
+            (key[:2], "" if key[2] == "." else f"{key[2]}/")
+            for key, recursive in keys.items()
+            if recursive
+        ]
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+            if prefixes:
+                for k in [
+                    k
+                    for k in self.entries
+                    if any(
+                        k[:2] == scope and (not prefix or k[2].startswith(prefix))
+                        for scope, prefix in prefixes
+                    )
+                ]:
+                    del self.entries[k]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = ListingCache()
@@ -0,0 +1,269 @@
+import os
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, local, current_thread
+from time import perf_counter
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    "filenavi_requests_total": (
+        "counter",
+        "Requests handled, by endpoint and status.",
+        ("endpoint", "method", "status"),
+    ),
+    "filenavi_request_duration_seconds": (
+        "histogram",
+        "Time until a response was returned, by endpoint.",
+        ("endpoint", "method"),
+    ),
+    "filenavi_sql_queries_total": (
+        "counter",
+        "SQL statements executed, by endpoint.",
+        ("endpoint",),
+    ),
+    "filenavi_sql_seconds_total": (
+        "counter",
+        "Time spent executing SQL statements, by endpoint.",
+        ("endpoint",),
+    ),
+    "filenavi_fs_seconds_total": (
+        "counter",
+        "Time spent in file system calls, by operation.",
+        ("endpoint", "operation"),
+    ),
+    "filenavi_fs_calls_total": (
+        "counter",
+        "File system calls made, by operation.",
+        ("endpoint", "operation"),
+    ),
+    "filenavi_upload_bytes_total": (
+        "counter",
+        "Bytes received in uploads.",
+        ("endpoint",),
+    ),
+    "filenavi_download_bytes_total": (
+        "counter",
+        "Bytes sent in downloads.",
+        ("endpoint",),
+    ),
+}
+
+
+class Store:
+    # Every thread only ever writes to its own store, so recording needs no
+    # locks; stores are only merged when the metrics are read.
+    def __init__(self):
+        self.endpoint = ""
+        self.start = None
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def merge(self, other: "Store"):
+        for key, value in other.counters.copy().items():
+            self.counters[key] += value
+        for key, value in other.histograms.copy().items():
+            merged = self.histograms.setdefault(key, [0] * len(value))
+            for i, v in enumerate(value):
+                merged[i] += v
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.local = local()
+        self.stores = {}
+        self.retired = Store()
+        self.lock = Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get("METRICS", False)
+        if not self.enabled:
+            return
+
+        app.before_request(self.begin)
+        app.after_request(self.end)
+        app.teardown_request(self.abort)
+        event.listen(Engine, "before_cursor_execute", self.before_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_execute)
+
+    @property
+    def store(self) -> Store:
+        store = getattr(self.local, "store", None)
+        if store is None:
+            store = self.local.store = Store()
+            with self.lock:
+                self.retire()
+                self.stores[current_thread()] = store
+        return store
+
+    def retire(self):
+        # Servers may start a thread per request, so the stores of threads
+        # that exited, which are never written to again, are folded into one.
+        for thread in [t for t in self.stores if not t.is_alive()]:
+            self.retired.merge(self.stores.pop(thread))
+
+    def add(self, name: str, values: tuple, amount: float = 1):
+        if self.enabled:
+            self.store.counters[name, values] += amount
+
+    def observe(self, name: str, values: tuple, amount: float):
+        histograms = self.store.histograms
+        histogram = histograms.get((name, values))
+        if histogram is None:
+            # One count per bucket, then the one above all of them and the sum.
+            histogram = [0] * (len(BUCKETS) + 1) + [0.0]
+            histograms[name, values] = histogram
+        histogram[bisect_left(BUCKETS, amount)] += 1
+        histogram[-1] += amount
+
+    @contextmanager
+    def timed(self, operation: str):
+        if not self.enabled:
+            yield
+            return
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            counters = self.store.counters
+            key = (self.store.endpoint, operation)
+            counters["filenavi_fs_seconds_total", key] += elapsed
+            counters["filenavi_fs_calls_total", key] += 1
+
+    def iterate(self, operation: str, iterable):
+        if not self.enabled:
+            return iterable
+
+        # Streamed bodies are consumed after the request was recorded, so the
+        # endpoint is taken now, like for streamed downloads.
+        key = (self.store.endpoint, operation)
+
+        def timed(it):
+            while True:
+                start = perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = perf_counter() - start
+                    self.add("filenavi_fs_seconds_total", key, elapsed)
+                yield item
+
+        return timed(iter(iterable))
+
+    def uploaded(self, size: int):
+        if self.enabled:
+            self.add("filenavi_upload_bytes_total", (self.store.endpoint,), size)
+
+    def downloaded(self, response):
+        if not self.enabled or request.method == "HEAD":
+            return response
+
+        key = (self.store.endpoint,)
+        if response.content_length is not None:
+            self.add("filenavi_download_bytes_total", key, response.content_length)
+            return response
+
+        # Streamed bodies, like archives, are counted as they are sent.
+        def count(body):
+            for chunk in body:
+                self.add("filenavi_download_bytes_total", key, len(chunk))
+                yield chunk
+
+        response.response = count(response.response)
+        return response
+
+    def begin(self):
+        store = self.store
+        store.endpoint = request.endpoint or ""
+        store.start = perf_counter()
+
+    def end(self, response):
+        self.record(response.status_code)
+        return response
+
+    def abort(self, error):
+        # Only requests that failed with an unhandled error are still open.
+        if self.store.start is not None:
+            self.record(500)
+
+    def record(self, status: int):
+        store = self.store
+        if store.start is None:
+            return
+        elapsed = perf_counter() - store.start
+        store.start = None
+
+        key = (store.endpoint, request.method)
+        store.counters["filenavi_requests_total", (*key, status)] += 1
+        self.observe("filenavi_request_duration_seconds", key, elapsed)
+        store.endpoint = ""
+
+    def before_execute(self, conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("filenavi_query_start", []).append(perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context, many):
+        elapsed = perf_counter() - conn.info["filenavi_query_start"].pop()
+        store = self.store
+        store.counters["filenavi_sql_queries_total", (store.endpoint,)] += 1
+        store.counters["filenavi_sql_seconds_total", (store.endpoint,)] += elapsed
+
+    def render(self) -> str:
+        total = Store()
+        with self.lock:
+            self.retire()
+            total.merge(self.retired)
+            stores = list(self.stores.values())
+        for store in stores:
+            total.merge(store)
+        counters, histograms = total.counters, total.histograms
+
+        # Every worker keeps its own numbers, so they are told apart by the
+        # process they come from.
+        worker = f'worker="{os.getpid()}"'
+        lines = []
+        for name, (kind, description, names) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (n, values), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{labels(names, values, worker)} {value}")
+                continue
+
+            for (n, values), value in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*BUCKETS, "+Inf"), value):
+                    cumulative += count
+                    tags = labels(names, values, f'le="{bound}",{worker}')
+                    lines.append(f"{name}_bucket{tags} {cumulative}")
+                tags = labels(names, values, worker)
+                lines.append(f"{name}_sum{tags} {value[-1]}")
+                lines.append(f"{name}_count{tags} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
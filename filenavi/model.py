@@ -1,16 +1,28 @@
+import os
+import errno
 from enum import Enum
-from shutil import rmtree
+from shutil import rmtree, copytree, copy2
 from pathlib import Path
-from os import rename
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread, Lock
 from datetime import datetime, timezone
 
 from flask_sqlalchemy import SQLAlchemy, event
-from sqlalchemy.orm import synonym, relationship, backref
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask import current_app, session
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session, synonym, relationship, backref
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from flask import current_app, session, g, has_app_context
+from sqlalchemy.exc import NoResultFound, IntegrityError
 from humanfriendly import format_size
 
+from . import listing, usercache
+from .hashing import hasher
+from .trash import Trash, measure
+
 db = SQLAlchemy()
 
 
@@ -56,8 +68,13 @@ class User(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text, unique=True, nullable=False)
-    _password = db.Column(db.Text, unique=False, nullable=False)
+    # Hashes are only loaded when a password is checked, so they are neither
+    # read by every lookup nor copied into the user cache.
+    _password = db.deferred(db.Column(db.Text, unique=False, nullable=False))
     rank = db.Column(db.Enum(Rank), unique=False, nullable=False)
+    session_epoch = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
 
     def __init__(
         self,
@@ -70,7 +87,10 @@ class User(db.Model):
         self.rank = rank
 
     def verify(self, password: str) -> bool:
-        return check_password_hash(self.password, password)
+        return hasher.verify(self.password, password)
+
+    def outdated(self) -> bool:
+        return hasher.outdated(self.password)
 
     def home(self, visibility=None, relpath=None) -> Path:
         parent = current_app.config["DATA_DIR"]
@@ -87,6 +107,22 @@ class User(db.Model):
 
         return parent.resolve()
 
+    def trash(self) -> Trash:
+        return Trash(self.home() / "trash")
+
+    def usage_of(self, visibility) -> int:
+        for usage in self.usage:
+            if usage.visibility == visibility:
+                return max(usage.size, 0)
+        return 0
+
+    def total_usage(self) -> int:
+        return sum(max(u.size, 0) for u in self.usage)
+
+    def fits(self, size: int) -> bool:
+        quota = current_app.config["QUOTA"]
+        return quota is None or self.total_usage() + size <= quota
+
     def has_access_to(self, thing):
         if isinstance(thing, User):
             return self == thing or (self.rank >= Rank.ADMIN and self.rank > thing.rank)
@@ -100,18 +136,111 @@ class User(db.Model):
 
     @password.setter
     def password(self, value):
-        self._password = generate_password_hash(value)
+        self._password = hasher.hash(value)
 
     password = synonym("_password", descriptor=password)
 
+    @staticmethod
+    def lookup(**kwargs):
+        if len(kwargs) != 1 or not kwargs.keys() <= {"id", "name"}:
+            raise ValueError("Lookup requires exactly one of id or name")
+
+        # Users are memoized for the duration of the request, so the URL
+        # converters, the authentication wrapper and the views share a single
+        # query per user.
+        identities = g.setdefault("identities", {})
+        key = next(iter(kwargs.items()))
+        if key not in identities:
+            values = usercache.cache.get(**kwargs)
+            if values is not None:
+                user = User.restore(values)
+            else:
+                try:
+                    user = User.query.filter_by(**kwargs).one()
+                except NoResultFound:
+                    user = None
+                else:
+                    usercache.cache.set(user.dump())
+            identities[key] = user
+            if user is not None:
+                identities["id", user.id] = user
+                identities["name", user.name] = user
+        return identities[key]
+
+    def dump(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "rank": self.rank.name,
+            "session_epoch": self.session_epoch,
+        }
+
+    @staticmethod
+    def restore(values: dict):
+        user = User.__mapper__.class_manager.new_instance()
+        for key, value in values.items():
+            if key == "rank":
+                value = Rank[value]
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def uncache(self, *names: str):
+        usercache.cache.invalidate(self.id, self.name, *names)
+
+    def revoke_sessions(self):
+        # Sessions may live in signed cookies that cannot be deleted, so they
+        # carry the epoch they were created in and are rejected once it moves.
+        self.session_epoch += 1
+
+    def authenticate(self):
+        session["user_id"] = self.id
+        session["session_epoch"] = self.session_epoch
+        session.permanent = True
+
     @staticmethod
     def current():
         if "user_id" in session:
-            try:
-                user = User.query.filter_by(id=session["user_id"]).one()
-            except NoResultFound:
+            user = User.lookup(id=session["user_id"])
+            if user is None:
                 return None
-            return user
+            if session.get("session_epoch", 0) == user.session_epoch:
+                return user
+
+
+# Committing expires every object, so the users memoized for the request
+# would be queried again on their next attribute access. Their values are
+# the ones just committed, so they are put back once the commit is done.
+@event.listens_for(Session, "before_commit")
+def remember_identities(session):
+    if not has_app_context() or "identities" not in g:
+        return
+    users = {id(u): u for u in g.identities.values() if u is not None}
+    g.remembered = [(u, dict(inspect(u).dict)) for u in users.values()]
+
+
+@event.listens_for(Session, "after_commit")
+def commit_identities(session):
+    if has_app_context() and "remembered" in g:
+        g.committed = g.pop("remembered")
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def forget_identities(session, previous_transaction):
+    if has_app_context():
+        g.pop("remembered", None)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def restore_identities(session, transaction):
+    # Objects are only expired after the after_commit event.
+    if not has_app_context() or "committed" not in g:
+        return
+    for user, values in g.pop("committed"):
+        if inspect(user).persistent:
+            for key in User.__mapper__.column_attrs.keys():
+                if key in values:
+                    set_committed_value(user, key, values[key])
 
 
 @event.listens_for(User, "after_insert")
@@ -145,6 +274,388 @@ class Visibility(Enum):
             return Visibility.PUBLIC
 
 
+class Usage(db.Model):
+    __tablename__ = "usage"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    visibility = db.Column(db.Enum(Visibility), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+
+    user = relationship("User", backref=backref("usage", cascade="all, delete-orphan"))
+
+    def __init__(self, user_id: int, visibility: Visibility, size: int = 0):
+        self.user_id = user_id
+        self.visibility = visibility
+        self.size = size
+
+    @staticmethod
+    def adjust(user_id: int, visibility: Visibility, delta: int):
+        if delta == 0:
+            return
+
+        # The counter is changed within the database, so that concurrent
+        # updates from several workers are not lost.
+        updated = Usage.query.filter_by(user_id=user_id, visibility=visibility).update(
+            {Usage.size: Usage.size + delta}, synchronize_session=False
+        )
+        if updated == 0:
+            db.session.add(Usage(user_id, visibility, delta))
+        db.session.commit()
+
+    @staticmethod
+    def rebuild(workers: int = 1):
+        from .upload import Upload
+
+        counters = {}
+        for user in User.query.all():
+            for visibility in Visibility:
+                counters[user.id, visibility] = [user.home(visibility)]
+            for entry in user.trash().entries():
+                counters[user.id, Visibility[entry.visibility]].append(entry)
+            for upload in Upload.pending(user):
+                counters[user.id, upload.visibility].append(upload)
+
+        def scan(items) -> int:
+            home, *entries = items
+            size = measure(home) if home.exists() else 0
+            return size + sum(entry.measure() for entry in entries)
+
+        # Walking the trees is dominated by stat calls, which release the GIL,
+        # so the homes are scanned in parallel threads.
+        with ThreadPoolExecutor(max(workers, 1)) as executor:
+            sizes = dict(zip(counters, executor.map(scan, counters.values())))
+
+        Usage.query.delete()
+        for (user_id, visibility), size in sizes.items():
+            db.session.add(Usage(user_id, visibility, size))
+        db.session.commit()
+
+    @staticmethod
+    def transfer(user_id: int, source, destination, size: int):
+        Usage.adjust(user_id, source, -size)
+        Usage.adjust(user_id, destination, size)
+
+    @staticmethod
+    def release(entry):
+        # Called for every trash entry that is purged in the background.
+        user_id = int(entry.root.parent.name)
+        Usage.adjust(user_id, Visibility[entry.visibility], -entry.measure())
+
+
+class Transfers:
+    # Toggling a directory is a single rename, while measuring it walks the
+    # whole tree, so that is left to a thread outside of the request.
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = None
+        self.lock = Lock()
+
+    def submit(self, user_id: int, source, destination, path: Path):
+        # Like the other pools, the thread is started on first use, so that
+        # it is never created in a process that forks into workers later.
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self.run, name="filenavi-usage", daemon=True
+                )
+                self.thread.start()
+        app = current_app._get_current_object()
+        self.queue.put((app, user_id, source, destination, path))
+
+    def run(self):
+        while True:
+            app, user_id, source, destination, path = self.queue.get()
+            with app.app_context():
+                try:
+                    Usage.transfer(user_id, source, destination, measure(path))
+                except Exception:
+                    app.logger.exception("Unable to measure %s", path)
+
+
+transfers = Transfers()
+
+
+def trigrams(text: str) -> set:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def scan_tree(home: Path, path: Path):
+    # Yields the path itself and everything below it, without following
+    # symbolic links to directories.
+    is_dir = path.is_dir() and not path.is_symlink()
+    yield path.relative_to(home).as_posix(), path.name, is_dir
+
+    stack = [path] if is_dir else []
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                p = Path(e.path)
+                is_dir = e.is_dir(follow_symlinks=False)
+                yield p.relative_to(home).as_posix(), e.name, is_dir
+                if is_dir:
+                    stack.append(p)
+
+
+class IndexEntry(db.Model):
+    __tablename__ = "index_entries"
+    __table_args__ = (db.UniqueConstraint("user_id", "visibility", "path"),)
+
+    BATCH_SIZE = 500
+    ATTEMPTS = 3
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    visibility = db.Column(db.Enum(Visibility), nullable=False)
+    path = db.Column(db.Text, nullable=False)
+    name = db.Column(db.Text, nullable=False)
+    folded = db.Column(db.Text, nullable=False)
+    is_dir = db.Column(db.Boolean, nullable=False)
+
+    @staticmethod
+    def scope(user_id: int, visibility: Visibility, path: str, subtree: bool = True):
+        condition = (IndexEntry.user_id == user_id) & (
+            IndexEntry.visibility == visibility
+        )
+        if path == ".":
+            return condition
+
+        # Descendants are matched by their prefix, which LIKE alone does not
+        # do exactly where it ignores case, as it does in SQLite.
+        match = IndexEntry.path == path
+        if subtree:
+            prefix = f"{path}/"
+            match |= IndexEntry.path.startswith(prefix, autoescape=True) & (
+                db.func.substr(IndexEntry.path, 1, len(prefix)) == prefix
+            )
+        return condition & match
+
+    @staticmethod
+    def apply(f, *args):
+        # The watcher indexes the same changes as the request that made them,
+        # so either side may find rows of the other in its way. The one that
+        # fails starts over, replacing what the other one wrote.
+        for attempt in range(IndexEntry.ATTEMPTS):
+            try:
+                f(*args)
+                db.session.commit()
+                return
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == IndexEntry.ATTEMPTS - 1:
+                    raise
+
+    @staticmethod
+    def insert(user_id: int, visibility: Visibility, rows):
+        rows = iter(rows)
+        while batch := list(islice(rows, IndexEntry.BATCH_SIZE)):
+            db.session.execute(
+                IndexEntry.__table__.insert(),
+                [
+                    {
+                        "user_id": user_id,
+                        "visibility": visibility,
+                        "path": path,
+                        "name": name,
+                        "folded": name.casefold(),
+                        "is_dir": is_dir,
+                    }
+                    for path, name, is_dir in batch
+                ],
+            )
+            ids = db.session.execute(
+                db.select(IndexEntry.id, IndexEntry.folded).where(
+                    IndexEntry.user_id == user_id,
+                    IndexEntry.visibility == visibility,
+                    IndexEntry.path.in_([path for path, _, _ in batch]),
+                )
+            )
+            grams = [
+                {
+                    "user_id": user_id,
+                    "visibility": visibility,
+                    "trigram": gram,
+                    "entry_id": id,
+                }
+                for id, folded in ids
+                for gram in trigrams(folded)
+            ]
+            if grams:
+                db.session.execute(IndexTrigram.__table__.insert(), grams)
+
+    @staticmethod
+    def delete(condition):
+        ids = db.select(IndexEntry.id).where(condition)
+        IndexTrigram.query.filter(IndexTrigram.entry_id.in_(ids)).delete(
+            synchronize_session=False
+        )
+        IndexEntry.query.filter(condition).delete(synchronize_session=False)
+
+    @staticmethod
+    def add(user_id: int, visibility: Visibility, home: Path, path: Path):
+        relpath = path.relative_to(home).as_posix()
+
+        def add():
+            IndexEntry.delete(IndexEntry.scope(user_id, visibility, relpath))
+            IndexEntry.insert(user_id, visibility, scan_tree(home, path))
+
+        IndexEntry.apply(add)
+
+    @staticmethod
+    def discard(user_id: int, visibility: Visibility, relpath: str):
+        IndexEntry.delete(IndexEntry.scope(user_id, visibility, relpath))
+        db.session.commit()
+
+    @staticmethod
+    def move(
+        user_id: int,
+        visibility: Visibility,
+        relpath: str,
+        new_visibility: Visibility,
+        new_home: Path,
+        new_path: Path,
+    ):
+        new_relpath = new_path.relative_to(new_home).as_posix()
+
+        def move():
+            # Whatever was replaced at the destination is dropped, and the
+            # moved entry itself is indexed again under its new name.
+            IndexEntry.delete(
+                IndexEntry.scope(user_id, new_visibility, new_relpath)
+            )
+            IndexEntry.delete(
+                IndexEntry.scope(user_id, visibility, relpath, subtree=False)
+            )
+
+            # Only the names are indexed, so the entries below it keep their
+            # trigrams and merely have their path prefix replaced.
+            descendants = IndexEntry.scope(user_id, visibility, relpath) & (
+                IndexEntry.path != relpath
+            )
+            if visibility != new_visibility:
+                ids = db.select(IndexEntry.id).where(descendants)
+                IndexTrigram.query.filter(IndexTrigram.entry_id.in_(ids)).update(
+                    {IndexTrigram.visibility: new_visibility},
+                    synchronize_session=False,
+                )
+            IndexEntry.query.filter(descendants).update(
+                {
+                    IndexEntry.visibility: new_visibility,
+                    IndexEntry.path: db.literal(new_relpath)
+                    + db.func.substr(IndexEntry.path, len(relpath) + 1),
+                },
+                synchronize_session=False,
+            )
+
+            is_dir = new_path.is_dir() and not new_path.is_symlink()
+            IndexEntry.insert(
+                user_id, new_visibility, [(new_relpath, new_path.name, is_dir)]
+            )
+
+        IndexEntry.apply(move)
+
+    @staticmethod
+    def search(user_id: int, visibility: Visibility, query: str, limit: int = 100):
+        needle = query.casefold()
+        grams = trigrams(needle)
+
+        if not grams:
+            q = IndexEntry.query.filter_by(user_id=user_id, visibility=visibility)
+        else:
+            scope = (IndexTrigram.user_id == user_id) & (
+                IndexTrigram.visibility == visibility
+            )
+
+            # Candidates are taken from the rarest trigram and checked against
+            # the others through the primary key, so that common trigrams are
+            # never scanned in full. Counting is capped, as only the order of
+            # the trigrams matters.
+            def frequency(gram: str) -> int:
+                sample = (
+                    db.select(IndexTrigram.entry_id)
+                    .where(scope, IndexTrigram.trigram == gram)
+                    .limit(IndexEntry.BATCH_SIZE)
+                    .subquery()
+                )
+                return db.session.execute(
+                    db.select(db.func.count()).select_from(sample)
+                ).scalar()
+
+            rarest, *others = sorted(grams, key=frequency)
+
+            # The entries are joined to the trigrams, rather than selected
+            # from a subquery, so that the search stops at the limit. The
+            # trigrams already carry the owner and visibility.
+            q = IndexEntry.query.join(
+                IndexTrigram, IndexTrigram.entry_id == IndexEntry.id
+            ).filter(scope, IndexTrigram.trigram == rarest)
+            for gram in others:
+                other = db.aliased(IndexTrigram)
+                q = q.filter(
+                    db.exists().where(
+                        other.user_id == user_id,
+                        other.visibility == visibility,
+                        other.trigram == gram,
+                        other.entry_id == IndexTrigram.entry_id,
+                    )
+                )
+
+        # The trigrams only narrow the candidates down, their order within
+        # the name is checked here. Results are sorted after the limit, so
+        # that the search can stop as soon as enough of them were found.
+        q = q.filter(IndexEntry.folded.contains(needle, autoescape=True))
+        return sorted(q.limit(limit).all(), key=lambda e: (e.folded, e.path))
+
+    @staticmethod
+    def rebuild(user, visibility: Visibility, full: bool = False):
+        home = user.home(visibility)
+        home.mkdir(parents=True, exist_ok=True)
+        entries = (e for e in scan_tree(home, home) if e[0] != ".")
+
+        if full:
+            IndexEntry.delete(IndexEntry.scope(user.id, visibility, "."))
+            IndexEntry.insert(user.id, visibility, entries)
+            db.session.commit()
+            return
+
+        indexed = dict(
+            db.session.execute(
+                db.select(IndexEntry.path, IndexEntry.id).where(
+                    IndexEntry.scope(user.id, visibility, ".")
+                )
+            ).all()
+        )
+        IndexEntry.insert(
+            user.id,
+            visibility,
+            (e for e in entries if indexed.pop(e[0], None) is None),
+        )
+
+        # Whatever is left was not found on disk anymore.
+        stale = list(indexed.values())
+        for i in range(0, len(stale), IndexEntry.BATCH_SIZE):
+            batch = stale[i : i + IndexEntry.BATCH_SIZE]
+            IndexEntry.delete(IndexEntry.id.in_(batch))
+        db.session.commit()
+
+
+class IndexTrigram(db.Model):
+    __tablename__ = "index_trigrams"
+    # Entries are deleted and moved by their id, which the primary key does
+    # not lead with.
+    __table_args__ = (db.Index("ix_index_trigrams_entry", "entry_id"),)
+
+    user_id = db.Column(db.Integer, primary_key=True)
+    visibility = db.Column(db.Enum(Visibility), primary_key=True)
+    trigram = db.Column(db.Text, primary_key=True)
+    entry_id = db.Column(
+        db.Integer, db.ForeignKey("index_entries.id"), primary_key=True
+    )
+
+
 class Share(db.Model):
     __tablename__ = "shares"
 
@@ -188,25 +699,48 @@ class File:
                 "modification": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
                 "symlink": self.path.is_symlink(),
                 "size": stat.st_size,
+                "inode": stat.st_ino,
             }
 
-    def move(self, new_path: Path, force: bool = False):
+    def move(self, new_path: Path, force: bool = False, progress=None):
         parent = self.owner.home(self.visibility)
-        if not new_path.is_relative_to(parent):
+        # The destination comes from the client, so ".." and symbolic links
+        # are resolved before it is checked against the home directory.
+        new_path = new_path.resolve()
+        if not new_path.is_relative_to(parent) or not self.path.is_relative_to(parent):
             raise ValueError("File must be within user directory")
 
         new_path.parents[0].mkdir(parents=True, exist_ok=True)
 
+        old_path = self.path
         if new_path.exists():
             if new_path.is_dir():
-                self.path = self.path.rename(new_path / self.path.name)
+                self.path = relocate(
+                    self.path, new_path / self.path.name, progress=progress
+                )
             else:
                 if not force:
                     raise ValueError("File already exists")
                 else:
-                    self.path = self.path.replace(new_path)
+                    replaced = new_path.lstat().st_size
+                    self.path = relocate(
+                        self.path, new_path, replace=True, progress=progress
+                    )
+                    Usage.adjust(self.owner.id, self.visibility, -replaced)
         else:
-            self.path = self.path.rename(new_path)
+            self.path = relocate(self.path, new_path, progress=progress)
+
+        IndexEntry.move(
+            self.owner.id,
+            self.visibility,
+            old_path.relative_to(parent).as_posix(),
+            self.visibility,
+            parent,
+            self.path,
+        )
+
+        self.invalidate(old_path)
+        self.invalidate(self.path)
 
     def mkdir(self):
         home = self.owner.home(self.visibility)
@@ -214,49 +748,129 @@ class File:
         if not self.path.is_relative_to(home):
             raise ValueError("File must be within user directory")
 
+        created = None
+        for p in [self.path, *self.path.parents]:
+            if p.exists() or p == home:
+                break
+            created = p
+
         self.path.mkdir(parents=True, exist_ok=True)
 
-    def remove(self, recursive: bool = False):
+        if created is not None:
+            IndexEntry.add(self.owner.id, self.visibility, home, created)
+
+        for parent in self.path.relative_to(home).parents:
+            listing.cache.invalidate(self.owner, self.visibility, parent)
+
+    def remove(self, recursive: bool = False, progress=None):
         home = self.owner.home(self.visibility)
 
         if not self.path.is_relative_to(home):
             raise ValueError("File must be within user directory")
 
-        if not self.path.exists():
+        if not self.path.exists() and not self.path.is_symlink():
             raise ValueError("File does not exist")
 
-        try:
-            self.path.unlink()
-        except IsADirectoryError:
+        entry = None
+        if self.path.is_dir() and not self.path.is_symlink() and not recursive:
+            self.path.rmdir()
+        else:
+            entry = self.discard(progress=progress)
+
+        IndexEntry.discard(
+            self.owner.id, self.visibility, self.path.relative_to(home).as_posix()
+        )
+
+        self.invalidate(self.path)
+        return entry
+
+    def discard(self, progress=None):
+        # Files are moved into the trash if it is on the same file system,
+        # which is a single rename no matter how large they are.
+        if current_app.config["TRASH"]:
+            relpath = self.path.relative_to(self.owner.home(self.visibility))
             try:
-                self.path.rmdir()
-            except OSError:
-                if not recursive:
+                return self.owner.trash().put(
+                    self.path, self.visibility.name, relpath.as_posix()
+                )
+            except OSError as e:
+                if e.errno != errno.EXDEV:
                     raise
-                else:
-                    rmtree(self.path)
 
-    def toggle(self, path: Path, force: bool = False):
+        # Files in the trash keep counting towards the usage of their
+        # visibility until they are purged, only deletions are accounted here.
+        purged = {"size": 0}
+
+        def count(size: int = 0, entries: int = 0):
+            purged["size"] += size
+            if progress is not None:
+                progress(size=size, entries=entries)
+
+        try:
+            purge(self.path, progress=count)
+        finally:
+            Usage.adjust(self.owner.id, self.visibility, -purged["size"])
+
+    def toggle(self, path: Path, force: bool = False, progress=None):
         new_visibility = self.visibility.toggle()
         new_path = self.owner.home(new_visibility, relpath=path)
 
         if not new_path.is_relative_to(self.owner.home(new_visibility)):
             raise ValueError("Path is not relative to home")
+        if not self.path.is_relative_to(self.owner.home(self.visibility)):
+            raise ValueError("File must be within user directory")
 
         new_path.parents[0].mkdir(parents=True, exist_ok=True)
 
+        replaced = 0
+
+        old_path = self.path
         if new_path.exists():
             if new_path.is_dir():
-                self.path = self.path.rename(new_path / self.path.name)
+                self.path = relocate(
+                    self.path, new_path / self.path.name, progress=progress
+                )
             else:
                 if not force:
                     raise ValueError("File already exists")
                 else:
-                    self.path = self.path.replace(new_path)
+                    replaced = new_path.lstat().st_size
+                    self.path = relocate(
+                        self.path, new_path, replace=True, progress=progress
+                    )
+        else:
+            self.path = relocate(self.path, new_path, progress=progress)
+
+        Usage.adjust(self.owner.id, new_visibility, -replaced)
+        # The tree changes visibility as a whole, so its size is needed to
+        # move it between the two usage counters. Directories are measured in
+        # the background unless this already runs as a job.
+        if progress is None and self.path.is_dir() and not self.path.is_symlink():
+            transfers.submit(self.owner.id, self.visibility, new_visibility, self.path)
         else:
-            self.path = self.path.rename(new_path)
+            Usage.transfer(
+                self.owner.id, self.visibility, new_visibility, measure(self.path)
+            )
+
+        IndexEntry.move(
+            self.owner.id,
+            self.visibility,
+            old_path.relative_to(self.owner.home(self.visibility)).as_posix(),
+            new_visibility,
+            self.owner.home(new_visibility),
+            self.path,
+        )
 
+        self.invalidate(old_path)
         self.visibility = new_visibility
+        self.invalidate(self.path)
+
+    def invalidate(self, path: Path = None):
+        path = self.path if path is None else path
+        relpath = path.relative_to(self.owner.home(self.visibility))
+
+        listing.cache.invalidate(self.owner, self.visibility, relpath.parent)
+        listing.cache.invalidate(self.owner, self.visibility, relpath, recursive=True)
 
     def is_accessible_by(self, user) -> bool:
         public = self.visibility == Visibility.PUBLIC and not self.path.is_dir()
@@ -273,3 +887,153 @@ class File:
     @staticmethod
     def format_size(size: int) -> str:
         return format_size(size, binary=True)
+
+
+def ignore(**counts):
+    pass
+
+
+def copy_file(source, destination, progress=ignore):
+    copy2(source, destination, follow_symlinks=False)
+    progress(size=os.lstat(destination).st_size, entries=1)
+    return destination
+
+
+def relocate(
+    source: Path, destination: Path, replace: bool = False, progress=None
+) -> Path:
+    progress = ignore if progress is None else progress
+
+    try:
+        return source.replace(destination) if replace else source.rename(destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # The destination is on another file system, so the data is copied next
+    # to it first and the source is only removed once the copy is complete.
+    temporary = destination.with_name(f".{destination.name}.filenavi-part")
+    try:
+        if source.is_dir() and not source.is_symlink():
+            copytree(
+                source,
+                temporary,
+                symlinks=True,
+                copy_function=partial(copy_file, progress=progress),
+            )
+        else:
+            copy_file(source, temporary, progress=progress)
+        os.replace(temporary, destination)
+    except BaseException:
+        if temporary.exists() or temporary.is_symlink():
+            purge(temporary)
+        raise
+
+    purge(source)
+    return destination
+
+
+def purge(path: Path, progress=None):
+    progress = ignore if progress is None else progress
+
+    if path.is_symlink() or not path.is_dir():
+        size = path.lstat().st_size
+        path.unlink()
+        progress(size=size, entries=1)
+        return
+
+    # Entries are removed one at a time instead of through rmtree so that the
+    # progress of large removals can be reported.
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            p = os.path.join(root, name)
+            size = os.lstat(p).st_size
+            os.unlink(p)
+            progress(size=size, entries=1)
+        for name in dirs:
+            p = os.path.join(root, name)
+            if os.path.islink(p):
+                os.unlink(p)
+            else:
+                os.rmdir(p)
+            progress(entries=1)
+    path.rmdir()
+    progress(entries=1)
+
+
+class JobKind(Enum):
+    MOVE = 1
+    TOGGLE = 2
+    REMOVE = 3
+
+    def __str__(self):
+        return self.name.capitalize()
+
+
+class JobState(Enum):
+    QUEUED = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+    def __str__(self):
+        return self.name.capitalize()
+
+    @property
+    def finished(self) -> bool:
+        return self in [JobState.DONE, JobState.FAILED]
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    kind = db.Column(db.Enum(JobKind), nullable=False)
+    state = db.Column(db.Enum(JobState), nullable=False)
+    visibility = db.Column(db.Enum(Visibility), nullable=False)
+    path = db.Column(db.Text, nullable=False)
+    destination = db.Column(db.Text, nullable=True)
+    force = db.Column(db.Boolean, nullable=False)
+    processed_size = db.Column(db.BigInteger, nullable=False)
+    processed_entries = db.Column(db.Integer, nullable=False)
+    message = db.Column(db.Text, nullable=True)
+    created = db.Column(db.DateTime, nullable=False)
+    updated = db.Column(db.DateTime, nullable=False)
+
+    owner = relationship("User", backref=backref("jobs", cascade="all, delete-orphan"))
+
+    def __init__(
+        self,
+        owner: User,
+        kind: JobKind,
+        visibility: Visibility,
+        path: str,
+        destination: str = None,
+        force: bool = False,
+    ):
+        self.owner = owner
+        self.kind = kind
+        self.state = JobState.QUEUED
+        self.visibility = visibility
+        self.path = path
+        self.destination = destination
+        self.force = force
+        self.processed_size = 0
+        self.processed_entries = 0
+        self.created = self.updated = datetime.utcnow()
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind.name,
+            "state": self.state.name,
+            "visibility": str(self.visibility),
+            "path": self.path,
+            "destination": self.destination,
+            "bytes": self.processed_size,
+            "entries": self.processed_entries,
+            "message": self.message,
+            "created": self.created.isoformat(),
+            "updated": self.updated.isoformat(),
+        }
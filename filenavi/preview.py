@@ -0,0 +1,52 @@
+import os
+from pathlib import Path
+
+EXTENSIONS = ["txt", "log"]
+WINDOW = 64 * 1024
+MAX_WINDOW = 1024 * 1024
+
+
+class Window:
+    __slots__ = ("text", "start", "end", "size")
+
+    def __init__(self, text: str, start: int, end: int, size: int):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.size = size
+
+
+def read(path: Path, offset: int, length: int) -> Window:
+    # Only the requested range is read (plus the byte before it), and it is
+    # then narrowed down to whole lines.
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if offset < 0:
+            offset = max(size + offset, 0)
+        start = min(offset, size)
+        data = os.pread(fd, min(length, size - start), start)
+        at_line = start == 0 or os.pread(fd, 1, start - 1) == b"\n"
+    finally:
+        os.close(fd)
+
+    end = start + len(data)
+    head, tail = 0, len(data)
+
+    if not at_line:
+        newline = data.find(b"\n")
+        if newline >= 0:
+            head = newline + 1
+    if end < size and not data.endswith(b"\n"):
+        newline = data.rfind(b"\n", head)
+        if newline >= 0:
+            tail = newline + 1
+
+    # A line longer than the window is cut rather than skipped, so that
+    # paging through the file always makes progress.
+    if head >= tail:
+        head, tail = 0, len(data)
+
+    return Window(
+        data[head:tail].decode(errors="replace"), start + head, start + tail, size
+    )
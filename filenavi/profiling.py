@@ -0,0 +1,139 @@
+import io
+import os
+import re
+import json
+import time
+import sys
+import pstats
+import cProfile
+from pathlib import Path
+from functools import partial
+from itertools import count
+from time import perf_counter
+
+from flask import request, g
+
+from . import model
+
+NAME_PATTERN = re.compile(r"[0-9]+-[0-9]+")
+SORT_KEYS = ["cumulative", "tottime", "calls"]
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.sample = 0
+        self.keep = 0
+        self.counter = count(1)
+
+    def init_app(self, app):
+        self.enabled = app.config.get("PROFILING", False)
+        if not self.enabled:
+            return
+
+        self.sample = app.config.get("PROFILING_SAMPLE", 0)
+        self.keep = app.config.get("PROFILING_KEEP", 100)
+        self.directory = app.config.get("PROFILING_DIR") or (
+            Path(app.instance_path) / "profiles"
+        )
+        app.before_request(self.begin)
+        app.after_request(self.end)
+        app.teardown_request(self.abort)
+
+    def wanted(self) -> bool:
+        # The session is only looked at when profiling is asked for, so that
+        # other requests keep skipping it.
+        if "profile" in request.args:
+            user = model.User.current()
+            if user is not None and user.rank == model.Rank.OWNER:
+                return True
+        return self.sample > 0 and next(self.counter) % self.sample == 0
+
+    def begin(self):
+        # Only one profiler can run per thread at a time.
+        if sys.getprofile() is not None or not self.wanted():
+            return
+
+        profile = cProfile.Profile()
+        g.profile = (profile, perf_counter())
+        profile.enable()
+
+    def end(self, response):
+        if "profile" not in g:
+            return response
+
+        profile, start = g.pop("profile")
+        details = self.details(response.status_code)
+        # Bodies that are streamed are rendered after this, so the profile
+        # only ends once the response has been sent.
+        response.call_on_close(partial(self.finish, profile, start, details))
+        return response
+
+    def abort(self, error):
+        if error is not None and "profile" in g:
+            profile, start = g.pop("profile")
+            self.finish(profile, start, self.details(500))
+
+    @staticmethod
+    def details(status: int) -> dict:
+        return {
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "endpoint": request.endpoint,
+            "status": status,
+        }
+
+    def finish(self, profile: cProfile.Profile, start: float, details: dict):
+        profile.disable()
+        details["duration"] = perf_counter() - start
+        details["created"] = time.time()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = f"{time.time_ns()}-{os.getpid()}"
+        profile.dump_stats(self.directory / f"{name}.prof")
+        with open(self.directory / f"{name}.json", "w") as f:
+            json.dump(details, f)
+
+        self.prune()
+
+    def prune(self):
+        names = sorted(p.stem for p in self.directory.glob("*.prof"))
+        for name in names[: max(len(names) - self.keep, 0)]:
+            for suffix in [".prof", ".json"]:
+                (self.directory / f"{name}{suffix}").unlink(missing_ok=True)
+
+    def path(self, name: str) -> Path:
+        if NAME_PATTERN.fullmatch(name) is None:
+            raise ValueError("Invalid profile")
+        path = self.directory / f"{name}.prof"
+        if not path.is_file():
+            raise ValueError("No such profile")
+        return path
+
+    def entries(self) -> list:
+        if self.directory is None or not self.directory.is_dir():
+            return []
+
+        rv = []
+        for path in self.directory.glob("*.json"):
+            try:
+                with open(path) as f:
+                    details = json.load(f)
+            except (OSError, ValueError):
+                continue
+            details["name"] = path.stem
+            rv.append(details)
+        return sorted(rv, key=lambda e: e["name"], reverse=True)
+
+    def report(self, name: str, sort: str = "cumulative", limit: int = 60) -> str:
+        if sort not in SORT_KEYS:
+            raise ValueError("Invalid sort key")
+
+        stream = io.StringIO()
+        stats = pstats.Stats(str(self.path(name)), stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+
+profiler = Profiler()
@@ -1,15 +1,13 @@
 from werkzeug.routing import BaseConverter, ValidationError
 from urllib.parse import quote
-from sqlalchemy.exc import NoResultFound
 
 from filenavi.model import Visibility, User
 
 
 class UserConverter(BaseConverter):
     def to_python(self, value: str) -> User:
-        try:
-            user = User.query.filter_by(name=value).one()
-        except NoResultFound:
+        user = User.lookup(name=value)
+        if user is None:
             raise ValidationError
 
         return user
@@ -1,25 +1,35 @@
 class GeneralError(Exception):
+    code = 400
+
     def __init__(self, message):
         super().__init__(self)
         self.message = message
 
 
 class NotAccessible(GeneralError):
+    code = 403
+
     def __init__(self):
         super().__init__("Not accessible")
 
 
 class Unauthorized(GeneralError):
+    code = 403
+
     def __init__(self):
         super().__init__("Unauthorized")
 
 
 class NotAuthenticated(GeneralError):
+    code = 401
+
     def __init__(self):
         super().__init__("Not authenticated")
 
 
 class AuthenticationFailure(GeneralError):
+    code = 401
+
     def __init__(self):
         super().__init__("Authentication failure")
 
@@ -27,3 +37,24 @@ class AuthenticationFailure(GeneralError):
 class MalformedRequest(GeneralError):
     def __init__(self):
         super().__init__("Malformed request")
+
+
+class Conflict(GeneralError):
+    code = 409
+
+    def __init__(self, message="Conflict"):
+        super().__init__(message)
+
+
+class QuotaExceeded(GeneralError):
+    code = 413
+
+    def __init__(self):
+        super().__init__("Quota exceeded")
+
+
+class Busy(GeneralError):
+    code = 503
+
+    def __init__(self):
+        super().__init__("Too many requests, try again later")
@@ -1,8 +1,24 @@
-from flask import session, Blueprint, redirect, url_for, render_template, request
+from flask import (
+    session,
+    Blueprint,
+    redirect,
+    url_for,
+    render_template,
+    request,
+    Response,
+    abort,
+    send_file,
+)
 
 from filenavi import model
-from .error import AuthenticationFailure, MalformedRequest
-from sqlalchemy.exc import NoResultFound
+from filenavi.metrics import metrics
+from filenavi.profiling import profiler, SORT_KEYS
+from .error import (
+    AuthenticationFailure,
+    MalformedRequest,
+    NotAuthenticated,
+    Unauthorized,
+)
 
 bp = Blueprint("site", __name__)
 
@@ -31,15 +47,21 @@ def login_handler():
     if not all(p in request.form for p in ["name", "password"]):
         raise MalformedRequest
 
-    try:
-        user = model.User.query.filter_by(name=request.form.get("name")).one()
-    except NoResultFound:
+    user = model.User.lookup(name=request.form.get("name"))
+    if user is None:
         raise AuthenticationFailure
 
     if not user.verify(request.form.get("password")):
         raise AuthenticationFailure
 
-    session["user_id"] = user.id
+    # Hashes made with an older method or cost are replaced while the
+    # password is at hand.
+    if user.outdated():
+        user.password = request.form.get("password")
+        model.db.session.commit()
+        user.uncache()
+
+    user.authenticate()
     return redirect(
         url_for("storage.browse", owner=user, visibility=model.Visibility.PRIVATE)
     )
@@ -50,3 +72,70 @@ def logout_handler():
     if "user_id" in session:
         del session["user_id"]
     return redirect(url_for(".login"))
+
+
+@bp.route("/metrics")
+def metrics_export():
+    if not metrics.enabled:
+        abort(404)
+
+    # Scrapers cannot log in, so they may authenticate with Basic instead.
+    user = model.User.current()
+    auth = request.authorization
+    if user is None and auth is not None and auth.username is not None:
+        candidate = model.User.lookup(name=auth.username)
+        if candidate is not None and candidate.verify(auth.password or ""):
+            user = candidate
+
+    if user is None:
+        raise NotAuthenticated
+    if user.rank != model.Rank.OWNER:
+        raise Unauthorized
+
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def require_owner():
+    user = model.User.current()
+    if user is None:
+        raise NotAuthenticated
+    if user.rank != model.Rank.OWNER:
+        raise Unauthorized
+    return user
+
+
+@bp.route("/profiles/")
+def profiles():
+    if not profiler.enabled:
+        abort(404)
+    user = require_owner()
+
+    return render_template(
+        "site/profiles.html", entries=profiler.entries(), user=user
+    )
+
+
+@bp.route("/profiles/<name>")
+def profile_report(name):
+    if not profiler.enabled:
+        abort(404)
+    user = require_owner()
+
+    sort = request.args.get("sort", "cumulative")
+    try:
+        if "download" in request.args:
+            return send_file(
+                profiler.path(name), as_attachment=True, download_name=f"{name}.prof"
+            )
+        report = profiler.report(name, sort)
+    except ValueError:
+        abort(404)
+
+    return render_template(
+        "site/profile.html",
+        name=name,
+        report=report,
+        sort=sort,
+        sort_keys=SORT_KEYS,
+        user=user,
+    )
@@ -1,3 +1,9 @@
+import json
+from pathlib import Path
+from time import monotonic
+from queue import Empty
+from urllib.parse import quote
+
 from flask import (
     Blueprint,
     flash,
@@ -6,70 +12,470 @@ from flask import (
     render_template,
     request,
     send_from_directory,
+    send_file,
+    current_app,
+    stream_template,
+    stream_with_context,
+    Response,
+    jsonify,
+    abort,
 )
 
-from filenavi import model
+from filenavi import (
+    model,
+    listing,
+    download,
+    archive,
+    events,
+    completion,
+    thumbnail,
+    preview,
+)
+from filenavi.metrics import metrics
+from filenavi.jobs import runner, heavy
+from filenavi.upload import Upload, DirectStreams
 from .wrap import require_authentication
-from .error import MalformedRequest, Unauthorized, NotAuthenticated, NotAccessible
+from .error import (
+    MalformedRequest,
+    Unauthorized,
+    NotAuthenticated,
+    NotAccessible,
+    Conflict,
+    QuotaExceeded,
+)
 
 INLINE_EXTENSIONS = ["txt", "pdf", "png", "jpg", "jpeg", "gif"]
+EVENT_STREAM_DURATION = 300
+EVENT_KEEPALIVE = 15
+COMPLETION_LIMIT = 20
 
 bp = Blueprint("storage", __name__)
 
 
+def accel_redirect(path):
+    relpath = path.relative_to(current_app.config["DATA_DIR"].resolve())
+    prefix = current_app.config["ACCEL_REDIRECT_PREFIX"].rstrip("/")
+    return quote(f"{prefix}/{relpath.as_posix()}")
+
+
+def deferrable(owner, visibility, kind, target, destination=None) -> bool:
+    if not runner.enabled:
+        return False
+
+    match kind:
+        case model.JobKind.MOVE:
+            return heavy(target.path, owner.home(visibility, destination))
+        case model.JobKind.TOGGLE:
+            return heavy(target.path, owner.home(visibility.toggle(), destination))
+        case model.JobKind.REMOVE:
+            # Only trees that cannot be renamed into the trash are deleted
+            # entry by entry, which is what takes long enough to be a job.
+            if not heavy(target.path):
+                return False
+            if not current_app.config["TRASH"]:
+                return True
+            return heavy(target.path, owner.trash().root)
+
+
+def enqueue(owner, visibility, kind, target, destination=None, force=False):
+    home = owner.home(visibility)
+    if not target.path.is_relative_to(home):
+        raise NotAccessible
+
+    return runner.submit(
+        model.Job(
+            owner,
+            kind,
+            visibility,
+            target.path.relative_to(home).as_posix(),
+            destination,
+            force,
+        )
+    )
+
+
+def buffered(chunks, size: int = 64 * 1024):
+    buf = []
+    length = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield "".join(buf)
+
+
 @bp.route("/<user:owner>/<visibility:visibility>/browse/")
 @bp.route("/<user:owner>/<visibility:visibility>/browse/<path:path>")
 def browse(owner, visibility, path=None):
-    user = model.User.current()
-
     home = owner.home(visibility)
     path = (home / path) if path is not None else home
     target = model.File(path, owner, visibility)
 
+    # Public files are served without looking at the session at all.
     if visibility == model.Visibility.PRIVATE:
+        user = model.User.current()
         if user is None:
             raise NotAuthenticated
         if not user.has_access_to(target):
             raise Unauthorized
 
     if not path.is_dir():
+        if not target.path.is_relative_to(home) or not target.path.is_file():
+            abort(404)
+
         as_attachment = True
         if any(str(target.path).lower().endswith(f".{e}") for e in INLINE_EXTENSIONS):
             as_attachment = False
-        return send_from_directory(
-            home, target.path.relative_to(home), as_attachment=as_attachment
-        )
+        match current_app.config["DOWNLOAD_OFFLOAD"]:
+            case None:
+                rv = download.send(target, as_attachment=as_attachment)
+            case "x-accel-redirect":
+                rv = download.redirect(
+                    target, accel_redirect(target.path), as_attachment=as_attachment
+                )
+            case _:
+                rv = send_from_directory(
+                    home, target.path.relative_to(home), as_attachment=as_attachment
+                )
+        return metrics.downloaded(rv)
 
+    user = model.User.current()
     if user is None or not user.has_access_to(target):
         raise Unauthorized
 
     if not request.path.endswith("/"):
         return redirect(f"{request.url}/")
 
-    files = []
+    sort = request.args.get("sort", "name")
+    order = request.args.get("order", "asc")
+    limit = request.args.get("limit", current_app.config["PAGE_SIZE"], type=int)
+    after = request.args.get("after")
+
+    if order not in ["asc", "desc"]:
+        raise MalformedRequest
+
+    view = None
+    if thumbnail.cache.enabled:
+        view = request.args.get("view", "list")
+        if view not in ["list", "grid"]:
+            raise MalformedRequest
+
+    stream = bool(
+        request.args.get("stream", current_app.config["STREAM_LISTINGS"], type=int)
+    )
+
+    cursor = None
+    if stream and limit <= 0 and "sort" not in request.args:
+        # Entries are rendered in directory order straight from scandir, so
+        # memory use does not depend on the size of the directory.
+        sort = None
+        try:
+            files = listing.stream(path, home)
+        except OSError:
+            raise NotAccessible
+    else:
+        try:
+            files = listing.cache.listdir(owner, visibility, home, path)
+        except OSError:
+            raise NotAccessible
+
+        try:
+            files, cursor = listing.paginate(
+                files, sort=sort, reverse=order == "desc", limit=limit, after=after
+            )
+        except ValueError:
+            raise MalformedRequest
+
+    parent = None
+    if path != home:
+        parent = path.parent.relative_to(home).as_posix()
+        if parent == ".":
+            parent = ""
+
+    live = None
+    if events.bus.enabled:
+        live = url_for(
+            "storage.listing_events",
+            owner=owner,
+            visibility=visibility,
+            path=f"{path.relative_to(home).as_posix()}/" if path != home else None,
+        )
+
+    context = {
+        "files": files,
+        "user": user,
+        "owner": owner,
+        "visibility": visibility,
+        "current": path.relative_to(home) if path != home else "",
+        "parent": parent,
+        "sort": sort,
+        "order": order,
+        "limit": request.args.get("limit"),
+        "after": after,
+        "cursor": cursor,
+        "live": live,
+        "view": view,
+        "thumbnails": thumbnail.EXTENSIONS if view == "grid" else [],
+        "previews": preview.EXTENSIONS,
+    }
+
+    if stream:
+        return Response(buffered(stream_template("storage/browse.html", **context)))
+
+    return render_template("storage/browse.html", **context)
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/preview/<path:path>")
+def preview_text(owner, visibility, path):
+    home = owner.home(visibility)
+    target = model.File(home / path, owner, visibility)
+
+    if visibility == model.Visibility.PRIVATE:
+        user = model.User.current()
+        if user is None:
+            raise NotAuthenticated
+        if not user.has_access_to(target):
+            raise Unauthorized
+
+    if not target.path.is_relative_to(home) or not target.path.is_file():
+        abort(404)
+    if target.path.suffix[1:].lower() not in preview.EXTENSIONS:
+        abort(404)
+
+    offset = request.args.get("offset", 0, type=int)
+    length = request.args.get("length", preview.WINDOW, type=int)
+    if length <= 0 or length > preview.MAX_WINDOW:
+        raise MalformedRequest
+
+    try:
+        window = preview.read(target.path, offset, length)
+    except OSError:
+        raise NotAccessible
+
+    relpath = target.path.relative_to(home).as_posix()
+    previous = None
+    if window.start > 0:
+        start = max(window.start - length, 0)
+        previous = url_for(
+            ".preview_text",
+            owner=owner,
+            visibility=visibility,
+            path=relpath,
+            offset=start,
+            length=window.start - start,
+        )
+    following = None
+    if window.end < window.size:
+        following = url_for(
+            ".preview_text",
+            owner=owner,
+            visibility=visibility,
+            path=relpath,
+            offset=window.end,
+            length=length,
+        )
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(
+            text=window.text,
+            start=window.start,
+            end=window.end,
+            size=window.size,
+            previous=previous,
+            next=following,
+        )
+
+    return render_template(
+        "storage/preview.html",
+        window=window,
+        previous=previous,
+        following=following,
+        relpath=relpath,
+        length=length,
+        user=model.User.current(),
+        owner=owner,
+        visibility=visibility,
+    )
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/thumbnail/<path:path>")
+def thumbnail_download(owner, visibility, path):
+    if not thumbnail.cache.enabled:
+        abort(404)
+
+    home = owner.home(visibility)
+    target = model.File(home / path, owner, visibility)
+
+    if visibility == model.Visibility.PRIVATE:
+        user = model.User.current()
+        if user is None:
+            raise NotAuthenticated
+        if not user.has_access_to(target):
+            raise Unauthorized
+
+    if not target.path.is_relative_to(home) or not target.path.is_file():
+        abort(404)
+    if target.path.suffix[1:].lower() not in thumbnail.EXTENSIONS:
+        abort(404)
+
+    size = request.args.get("size", 256, type=int)
+    if size not in thumbnail.SIZES:
+        raise MalformedRequest
+
     try:
-        for f in path.iterdir():
-            f = f.relative_to(home)
+        rendered, mimetype = thumbnail.cache.get(target.path, size)
+    except ValueError:
+        abort(404)
+
+    # The name of a thumbnail is derived from the path, size and modification
+    # time of the image and the requested size, so it makes for an entity tag
+    # that changes whenever the image is replaced or written to.
+    rv = send_file(rendered, mimetype=mimetype, etag=rendered.stem, conditional=True)
+    return metrics.downloaded(rv)
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/events/")
+@bp.route("/<user:owner>/<visibility:visibility>/events/<path:path>")
+@require_authentication
+def listing_events(owner, visibility, path=None):
+    user = model.User.current()
+
+    if not events.bus.enabled:
+        abort(404)
+
+    home = owner.home(visibility)
+    path = (home / path) if path is not None else home
+    target = model.File(path, owner, visibility)
+
+    if not user.has_access_to(target):
+        raise Unauthorized
 
-            files.append(model.File(f, owner, visibility))
-    except:
+    if not target.path.is_relative_to(home) or not target.path.is_dir():
         raise NotAccessible
 
-    parent = None
-    if not home.samefile(path):
-        parent = model.File(path.parent, owner, visibility)
+    relpath = target.path.relative_to(home).as_posix()
+
+    # Streams are closed after a while and reopened by the browser, so that
+    # a forgotten tab does not hold on to a worker thread forever.
+    def generate():
+        with events.bus.listen(owner, visibility, relpath) as queue:
+            yield f"retry: {EVENT_KEEPALIVE * 1000}\n\n"
+            deadline = monotonic() + EVENT_STREAM_DURATION
+            while monotonic() < deadline:
+                try:
+                    event = queue.get(timeout=EVENT_KEEPALIVE)
+                except Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: change\ndata: {json.dumps(event)}\n\n"
+
+    rv = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    rv.headers["Cache-Control"] = "no-cache"
+    rv.headers["X-Accel-Buffering"] = "no"
+    return rv
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/search")
+@require_authentication
+def search(owner, visibility):
+    user = model.User.current()
+
+    if not user.has_access_to(owner):
+        raise Unauthorized
+
+    query = request.args.get("q", "")
+    limit = request.args.get("limit", current_app.config["PAGE_SIZE"], type=int)
+    if limit <= 0:
+        limit = None
+
+    results = []
+    if query:
+        results = model.IndexEntry.search(owner.id, visibility, query, limit=limit)
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(
+            results=[
+                {
+                    "path": r.path,
+                    "name": r.name,
+                    "directory": r.is_dir,
+                    "location": url_for(
+                        ".browse", owner=owner, visibility=visibility, path=r.path
+                    ),
+                }
+                for r in results
+            ]
+        )
 
     return render_template(
-        "storage/browse.html",
-        files=files,
+        "storage/search.html",
+        results=results,
+        query=query,
         user=user,
         owner=owner,
         visibility=visibility,
-        current=path.relative_to(home) if path != home else "",
-        parent=parent,
     )
 
 
+@bp.route("/<user:owner>/<visibility:visibility>/directories")
+@require_authentication
+def directories(owner, visibility):
+    user = model.User.current()
+
+    if not user.has_access_to(owner):
+        raise Unauthorized
+
+    prefix = request.args.get("prefix", "")
+    limit = request.args.get("limit", COMPLETION_LIMIT, type=int)
+    if limit <= 0 or limit > COMPLETION_LIMIT:
+        limit = COMPLETION_LIMIT
+
+    return jsonify(
+        directories=completion.cache.complete(
+            owner, visibility, owner.home(visibility), prefix, limit
+        )
+    )
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/archive/")
+@bp.route("/<user:owner>/<visibility:visibility>/archive/<path:path>")
+@require_authentication
+def archive_download(owner, visibility, path=None):
+    user = model.User.current()
+
+    home = owner.home(visibility)
+    path = (home / path) if path is not None else home
+    target = model.File(path, owner, visibility)
+
+    if not user.has_access_to(target):
+        raise Unauthorized
+
+    if not target.path.is_relative_to(home) or not target.path.is_dir():
+        raise NotAccessible
+
+    format = request.args.get("format", "zip")
+    if format not in archive.FORMATS:
+        raise MalformedRequest
+
+    try:
+        chunks = archive.stream(
+            home, target.path, format, request.args.get("compression", "store")
+        )
+    except ValueError:
+        raise MalformedRequest
+
+    mimetype, suffix = archive.FORMATS[format]
+    name = target.path.name if target.path != home else f"{owner.name}-{visibility}"
+
+    rv = Response(chunks, mimetype=mimetype, direct_passthrough=True)
+    rv.headers.set("Content-Disposition", **download.disposition(name + suffix, True))
+    return metrics.downloaded(rv)
+
+
 @bp.route("/<user:owner>/<visibility:visibility>/browse/", methods=["POST"])
 @bp.route(
     "/<user:owner>/<visibility:visibility>/browse/<path:path>", methods=["POST"]
@@ -78,22 +484,42 @@ def browse(owner, visibility, path=None):
 def browse_handler(owner, visibility, path=None):
     user = model.User.current()
 
-    if "files" not in request.files and "directory" not in request.form:
-        raise MalformedRequest
-
     home = owner.home(visibility)
     path = (home / path) if path is not None else home
     target = model.File(path, owner, visibility)
 
+    # Access is checked before the body is parsed, as parsing already writes
+    # the uploaded files into the target directory.
     if not user.has_access_to(target):
         raise Unauthorized
 
-    if "files" in request.files:
-        uploads = request.files.getlist("files")
-        for upload in uploads:
-            if upload.filename == "":
+    if request.mimetype == "multipart/form-data" and not owner.fits(
+        request.content_length or 0
+    ):
+        raise QuotaExceeded
+
+    with DirectStreams(path) as streams:
+        if path.is_dir():
+            request.stream_factory = streams
+
+        if "files" not in request.files and "directory" not in request.form:
+            raise MalformedRequest
+
+        if "files" in request.files:
+            uploads = request.files.getlist("files")
+            added = 0
+            try:
+                for upload in uploads:
+                    added += streams.commit(upload, upload.filename)
+                    model.IndexEntry.add(
+                        owner.id, visibility, home, path / upload.filename
+                    )
+            except ValueError:
                 raise MalformedRequest
-            upload.save(path / upload.filename)
+            finally:
+                model.Usage.adjust(owner.id, visibility, added)
+                listing.cache.invalidate(owner, visibility, path.relative_to(home))
+
     if "directory" in request.form:
         if request.form["directory"] == "":
             raise MalformedRequest
@@ -160,9 +586,14 @@ def move_handler(owner, visibility, path=None):
         flash("No such file or directory", "error")
         return rv
 
+    force = "replace" in request.form
+    kind = model.JobKind.MOVE
+    if deferrable(owner, visibility, kind, target, request.form["path"]):
+        job = enqueue(owner, visibility, kind, target, request.form["path"], force)
+        return redirect(url_for(".job_status", owner=owner, job_id=job.id))
+
     try:
-        force = "replace" in request.form
-        target.move(home / request.form["move-path"], force=force)
+        target.move(owner.home(visibility, request.form["path"]), force=force)
     except ValueError:
         flash("Unable to move file", "error")
         return rv
@@ -219,11 +650,14 @@ def toggle_handler(owner, visibility, path=None):
     if "path" not in request.form:
         raise MalformedRequest
 
+    force = "replace" in request.form
+    kind = model.JobKind.TOGGLE
+    if deferrable(owner, visibility, kind, target, request.form["path"]):
+        job = enqueue(owner, visibility, kind, target, request.form["path"], force)
+        return redirect(url_for(".job_status", owner=owner, job_id=job.id))
+
     try:
-        force = "replace" in request.form
         # TODO: Do not require a Path object
-        from pathlib import Path
-
         target.toggle(Path(request.form["path"]), force=force)
     except ValueError:
         flash("Cannot toggle visibility", "error")
@@ -279,12 +713,366 @@ def remove_handler(owner, visibility, path=None):
     )
 
     recursive = "recursive" in request.form
+    kind = model.JobKind.REMOVE
+    if recursive and deferrable(owner, visibility, kind, target):
+        job = enqueue(owner, visibility, kind, target, force=True)
+        return redirect(url_for(".job_status", owner=owner, job_id=job.id))
+
     try:
-        target.remove(recursive=recursive)
+        entry = target.remove(recursive=recursive)
     except ValueError:
         flash("No such file or directory", "error")
         return rv
     except OSError:
         flash("Cannot remove file or directory", "error")
         return rv
+
+    if entry is not None:
+        flash(f"Moved {target.path.name} to the trash")
     return rv
+
+
+BATCH_ACTIONS = {
+    "move": model.JobKind.MOVE,
+    "toggle": model.JobKind.TOGGLE,
+    "remove": model.JobKind.REMOVE,
+}
+BATCH_ERRORS_SHOWN = 10
+
+
+def batch_item(owner, visibility, kind, relpath, destination, force, recursive):
+    home = owner.home(visibility)
+    target = model.File(Path(relpath), owner, visibility)
+    result = {"path": relpath, "ok": False}
+
+    if not target.path.is_relative_to(home) or target.path == home:
+        return dict(result, error="Not accessible")
+    if not target.path.exists() and not target.path.is_symlink():
+        return dict(result, error="No such file or directory")
+
+    if kind == model.JobKind.TOGGLE:
+        destination = relpath
+
+    # Non-recursive removals only ever unlink a file or an empty directory.
+    queueable = kind != model.JobKind.REMOVE or recursive
+
+    try:
+        if queueable and deferrable(owner, visibility, kind, target, destination):
+            job = enqueue(owner, visibility, kind, target, destination, force)
+            return dict(
+                result,
+                ok=True,
+                job=url_for(".job_status", owner=owner, job_id=job.id),
+            )
+
+        match kind:
+            case model.JobKind.MOVE:
+                target.move(owner.home(visibility, destination), force=force)
+            case model.JobKind.TOGGLE:
+                target.toggle(Path(destination), force=force)
+            case model.JobKind.REMOVE:
+                entry = target.remove(recursive=recursive)
+                if entry is not None:
+                    result["trash"] = entry.token
+    except ValueError as e:
+        return dict(result, error=str(e))
+    except OSError as e:
+        return dict(result, error=e.strerror or "Operation failed")
+
+    return dict(result, ok=True)
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/batch/", methods=["POST"])
+@require_authentication
+def batch_handler(owner, visibility):
+    user = model.User.current()
+
+    # Every path in a batch shares the owner and visibility, so access is
+    # checked once for all of them.
+    if not user.has_access_to(owner):
+        raise Unauthorized
+
+    paths = request.form.getlist("paths")
+    if request.form.get("action") not in BATCH_ACTIONS or not paths:
+        raise MalformedRequest
+
+    kind = BATCH_ACTIONS[request.form["action"]]
+    force = "replace" in request.form
+    recursive = "recursive" in request.form
+
+    destination = None
+    if kind == model.JobKind.MOVE:
+        if "destination" not in request.form:
+            raise MalformedRequest
+        destination = request.form["destination"]
+        try:
+            model.File(Path(destination), owner, visibility).mkdir()
+        except (ValueError, OSError):
+            raise MalformedRequest
+
+    with listing.cache.deferred():
+        results = [
+            batch_item(owner, visibility, kind, p, destination, force, recursive)
+            for p in paths
+        ]
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(results=results)
+
+    failed = [r for r in results if not r["ok"]]
+    flash(f"Processed {len(results) - len(failed)} of {len(results)} files")
+    for r in failed[:BATCH_ERRORS_SHOWN]:
+        flash(f"{r['path']}: {r['error']}", "error")
+    if len(failed) > BATCH_ERRORS_SHOWN:
+        flash(f"{len(failed) - BATCH_ERRORS_SHOWN} more files failed", "error")
+
+    return redirect(
+        url_for(
+            ".browse",
+            owner=owner,
+            visibility=visibility,
+            path=request.form.get("directory") or None,
+        )
+    )
+
+
+def load_trash_entry(user, owner, token):
+    if not user.has_access_to(owner):
+        raise Unauthorized
+
+    try:
+        return owner.trash().load(token)
+    except ValueError:
+        raise NotAccessible
+
+
+@bp.route("/<user:owner>/trash/")
+@require_authentication
+def trash(owner):
+    user = model.User.current()
+
+    if not user.has_access_to(owner):
+        raise Unauthorized
+
+    entries = list(reversed(owner.trash().entries()))
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(entries=[dict(e.state(), token=e.token) for e in entries])
+
+    return render_template(
+        "storage/trash.html", entries=entries, user=user, owner=owner
+    )
+
+
+@bp.route("/<user:owner>/trash/<token>/restore", methods=["POST"])
+@require_authentication
+def trash_restore(owner, token):
+    user = model.User.current()
+
+    entry = load_trash_entry(user, owner, token)
+
+    visibility = model.Visibility[entry.visibility]
+    home = owner.home(visibility)
+    target = model.File(Path(entry.path), owner, visibility)
+
+    if not target.path.is_relative_to(home):
+        raise NotAccessible
+
+    try:
+        entry.restore(target.path)
+    except FileExistsError:
+        raise Conflict("File already exists")
+    model.IndexEntry.add(owner.id, visibility, home, target.path)
+    target.invalidate()
+
+    return redirect(
+        url_for(
+            ".browse",
+            owner=owner,
+            visibility=visibility,
+            path=target.path.relative_to(home).parents[0],
+        )
+    )
+
+
+@bp.route("/<user:owner>/trash/<token>/purge", methods=["POST"])
+@require_authentication
+def trash_purge(owner, token):
+    user = model.User.current()
+
+    entry = load_trash_entry(user, owner, token)
+    entry.measure()
+    if entry.purge():
+        model.Usage.release(entry)
+
+    return redirect(url_for(".trash", owner=owner))
+
+
+@bp.route("/<user:owner>/jobs/")
+@require_authentication
+def job_listing(owner):
+    user = model.User.current()
+
+    if not user.has_access_to(owner):
+        raise Unauthorized
+
+    jobs = (
+        model.Job.query.filter_by(owner_id=owner.id)
+        .order_by(model.Job.id.desc())
+        .limit(current_app.config["PAGE_SIZE"] or None)
+        .all()
+    )
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(jobs=[j.status() for j in jobs])
+
+    return render_template("storage/jobs.html", jobs=jobs, user=user, owner=owner)
+
+
+@bp.route("/<user:owner>/jobs/<int:job_id>")
+@require_authentication
+def job_status(owner, job_id):
+    user = model.User.current()
+
+    if not user.has_access_to(owner):
+        raise Unauthorized
+
+    job = model.Job.query.filter_by(id=job_id, owner_id=owner.id).one_or_none()
+    if job is None:
+        raise NotAccessible
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(job.status())
+
+    return render_template("storage/job.html", job=job, user=user, owner=owner)
+
+
+def load_upload(user, owner, visibility, token):
+    try:
+        pending = Upload.load(owner, token)
+    except ValueError:
+        raise NotAccessible
+
+    if pending.visibility != visibility:
+        raise NotAccessible
+
+    if not user.has_access_to(model.File(pending.directory, owner, visibility)):
+        raise Unauthorized
+
+    return pending
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/uploads/", methods=["POST"])
+@require_authentication
+def upload_create(owner, visibility):
+    user = model.User.current()
+
+    if not all(p in request.form for p in ["path", "name", "size"]):
+        raise MalformedRequest
+
+    home = owner.home(visibility)
+    target = model.File(home / request.form["path"], owner, visibility)
+
+    if not user.has_access_to(target):
+        raise Unauthorized
+
+    try:
+        size = int(request.form["size"])
+    except ValueError:
+        raise MalformedRequest
+
+    if not owner.fits(size):
+        raise QuotaExceeded
+
+    try:
+        pending = Upload.create(
+            owner,
+            visibility,
+            target.path.relative_to(home),
+            request.form["name"],
+            size,
+            current_app.config["UPLOAD_CHUNK_SIZE"],
+        )
+    except ValueError:
+        raise MalformedRequest
+
+    rv = pending.status()
+    rv["location"] = url_for(
+        ".upload_status", owner=owner, visibility=visibility, token=pending.token
+    )
+    return jsonify(rv), 201
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/uploads/<token>")
+@require_authentication
+def upload_status(owner, visibility, token):
+    user = model.User.current()
+
+    pending = load_upload(user, owner, visibility, token)
+
+    try:
+        return jsonify(pending.status())
+    except ValueError:
+        raise NotAccessible
+
+
+@bp.route(
+    "/<user:owner>/<visibility:visibility>/uploads/<token>/<int:offset>",
+    methods=["PUT"],
+)
+@require_authentication
+def upload_chunk(owner, visibility, token, offset):
+    user = model.User.current()
+
+    pending = load_upload(user, owner, visibility, token)
+
+    if request.content_length is None:
+        raise MalformedRequest
+
+    try:
+        pending.write(offset, request.stream, request.content_length)
+    except ValueError:
+        raise MalformedRequest
+
+    return "", 204
+
+
+@bp.route(
+    "/<user:owner>/<visibility:visibility>/uploads/<token>/finalize",
+    methods=["POST"],
+)
+@require_authentication
+def upload_finalize(owner, visibility, token):
+    user = model.User.current()
+
+    pending = load_upload(user, owner, visibility, token)
+
+    try:
+        target = pending.finalize(force="replace" in request.form)
+    except ValueError:
+        raise MalformedRequest
+    except FileExistsError as e:
+        raise Conflict(str(e))
+
+    return jsonify(
+        location=url_for(
+            ".browse",
+            owner=owner,
+            visibility=visibility,
+            path=target.path.relative_to(owner.home(visibility)),
+        )
+    )
+
+
+@bp.route("/<user:owner>/<visibility:visibility>/uploads/<token>", methods=["DELETE"])
+@require_authentication
+def upload_abort(owner, visibility, token):
+    user = model.User.current()
+
+    pending = load_upload(user, owner, visibility, token)
+    try:
+        pending.abort()
+    except ValueError:
+        raise NotAccessible
+
+    return "", 204
@@ -1,4 +1,4 @@
-from flask import Blueprint, flash, redirect, url_for, render_template, request
+from flask import Blueprint, flash, redirect, url_for, render_template, request, session
 
 from filenavi import model
 from .wrap import require_authentication
@@ -88,9 +88,11 @@ def name_handler(owner):
     if "name" not in request.form:
         raise MalformedRequest
 
+    old_name = owner.name
     owner.name = request.form["name"]
 
     model.db.session.commit()
+    owner.uncache(old_name)
     return redirect(url_for(".profile", owner=owner))
 
 
@@ -130,6 +132,7 @@ def rank_handler(owner):
     owner.rank = new_rank
 
     model.db.session.commit()
+    owner.uncache()
 
     return redirect(url_for(".profile", owner=owner))
 
@@ -166,7 +169,11 @@ def password_handler(owner):
         flash("Passwords do not match", "error")
         return redirect(url_for(".profile", owner=owner))
     owner.password = request.form["new-password"]
+    owner.revoke_sessions()
     model.db.session.commit()
+    owner.uncache()
+    if owner == user:
+        owner.authenticate()
     return redirect(url_for(".profile", owner=owner))
 
 
@@ -204,6 +211,7 @@ def delete_handler(owner):
 
     model.db.session.delete(owner)
     model.db.session.commit()
+    owner.uncache()
 
     if owner == user:
         if "user_id" in session:
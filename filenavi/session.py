@@ -0,0 +1,103 @@
+import os
+import secrets
+from pathlib import Path
+
+from flask.sessions import SessionInterface, SessionMixin
+
+
+class LazySession(SessionMixin):
+    def __init__(self, load):
+        self.load = load
+        self.session = None
+
+    @property
+    def loaded(self):
+        if self.session is None:
+            self.session = self.load()
+        return self.session
+
+    def __getitem__(self, key):
+        return self.loaded[key]
+
+    def __setitem__(self, key, value):
+        self.loaded[key] = value
+
+    def __delitem__(self, key):
+        del self.loaded[key]
+
+    def __iter__(self):
+        return iter(self.loaded)
+
+    def __len__(self):
+        return len(self.loaded)
+
+    @property
+    def permanent(self) -> bool:
+        return self.loaded.permanent
+
+    @permanent.setter
+    def permanent(self, value: bool):
+        self.loaded.permanent = value
+
+    @property
+    def modified(self) -> bool:
+        return self.session is not None and self.session.modified
+
+    @property
+    def accessed(self) -> bool:
+        return self.session is not None and self.session.accessed
+
+
+class LazySessionInterface(SessionInterface):
+    # Sessions are only loaded from their store once a view asks for them,
+    # so that requests which never look at the user, like downloads of public
+    # files, do not wait on the store at all.
+    def __init__(self, interface: SessionInterface):
+        self.interface = interface
+
+    def open_session(self, app, request):
+        def load():
+            rv = self.interface.open_session(app, request)
+            if rv is None:
+                rv = self.interface.make_null_session(app)
+            return rv
+
+        return LazySession(load)
+
+    def save_session(self, app, session, response):
+        if session.session is None or self.interface.is_null_session(session.session):
+            return
+        self.interface.save_session(app, session.session, response)
+
+
+def connect(url: str, max_connections: int, timeout: float):
+    from redis import Redis, BlockingConnectionPool
+
+    # Requests wait for a free connection rather than opening ever more, and
+    # give up instead of hanging when Redis does not answer.
+    pool = BlockingConnectionPool.from_url(
+        url,
+        max_connections=max_connections,
+        timeout=timeout,
+        socket_timeout=timeout,
+        socket_connect_timeout=timeout,
+    )
+    return Redis(connection_pool=pool)
+
+
+def secret_key(path: Path) -> bytes:
+    # The key is written in full before it is linked into place, so workers
+    # starting at the same time agree on a single key.
+    if not path.exists():
+        temporary = path.with_name(f".{path.name}.{os.getpid()}")
+        with open(os.open(temporary, os.O_WRONLY | os.O_CREAT, 0o600), "wb") as f:
+            f.write(secrets.token_bytes(32))
+        try:
+            os.link(temporary, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temporary)
+
+    with open(path, "rb") as f:
+        return f.read()
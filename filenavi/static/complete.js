@@ -0,0 +1,44 @@
+'use strict';
+
+const COMPLETION_DELAY = 100;
+
+document.addEventListener('DOMContentLoaded', () => {
+    for (let input of document.querySelectorAll('input[data-directories]')) {
+        let list = document.getElementById(input.getAttribute('list'));
+        let timer = null;
+        let controller = null;
+
+        input.addEventListener('input', () => {
+            clearTimeout(timer);
+            timer = setTimeout(async () => {
+                // Answers to earlier keystrokes are dropped, so that they never
+                // replace the suggestions for what was typed last.
+                if (controller !== null) {
+                    controller.abort();
+                }
+                controller = new AbortController();
+
+                let url = new URL(input.dataset.directories, window.location.href);
+                url.searchParams.set('prefix', input.value);
+
+                try {
+                    let response = await fetch(url, {
+                        credentials: 'same-origin',
+                        headers: {'Accept': 'application/json'},
+                        signal: controller.signal,
+                    });
+                    if (!response.ok) {
+                        return;
+                    }
+
+                    let {directories} = await response.json();
+                    list.replaceChildren(...directories.map((path) => {
+                        let option = document.createElement('option');
+                        option.value = `${path}/`;
+                        return option;
+                    }));
+                } catch (error) {}
+            }, COMPLETION_DELAY);
+        });
+    }
+});
@@ -0,0 +1,41 @@
+'use strict';
+
+const REFRESH_DELAY = 500;
+
+async function refreshListing(listing) {
+    let response = await fetch(window.location.href, {credentials: 'same-origin'});
+    if (!response.ok) {
+        return;
+    }
+
+    let page = new DOMParser().parseFromString(await response.text(), 'text/html');
+    let fresh = page.querySelector('ul.file-listing');
+    if (fresh === null) {
+        return;
+    }
+
+    // Selections made for a batch action survive the refresh.
+    let checked = new Set(
+        Array.from(listing.querySelectorAll('input[name="paths"]:checked'), (input) => input.value)
+    );
+    for (let input of fresh.querySelectorAll('input[name="paths"]')) {
+        input.checked = checked.has(input.value);
+    }
+
+    listing.replaceChildren(...fresh.childNodes);
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    let listing = document.querySelector('ul.file-listing[data-events]');
+    if (listing === null || !('EventSource' in window)) {
+        return;
+    }
+
+    let timer = null;
+    let source = new EventSource(listing.dataset.events);
+    source.addEventListener('change', () => {
+        // Bursts of changes, like an extracted archive, cause a single refresh.
+        clearTimeout(timer);
+        timer = setTimeout(() => refreshListing(listing), REFRESH_DELAY);
+    });
+});
@@ -0,0 +1,47 @@
+'use strict';
+
+document.addEventListener('DOMContentLoaded', () => {
+    let pre = document.querySelector('pre.preview');
+    if (pre === null || !('fetch' in window)) {
+        return;
+    }
+
+    // Further windows are loaded into the same page instead of replacing it,
+    // so that a file can be read on without losing what came before.
+    for (let [selector, key, insert] of [
+        ['a.preview-previous', 'previous', (text) => pre.prepend(text)],
+        ['a.preview-next', 'next', (text) => pre.append(text)],
+    ]) {
+        let link = document.querySelector(selector);
+        if (link === null) {
+            continue;
+        }
+
+        link.addEventListener('click', async (event) => {
+            event.preventDefault();
+
+            let response = await fetch(link.href, {
+                credentials: 'same-origin',
+                headers: {'Accept': 'application/json'},
+            });
+            if (!response.ok) {
+                window.location.href = link.href;
+                return;
+            }
+
+            let chunk = await response.json();
+            insert(chunk.text);
+            if (key === 'previous') {
+                document.querySelector('span.preview-start').textContent = chunk.start;
+            } else {
+                document.querySelector('span.preview-end').textContent = chunk.end;
+            }
+
+            if (chunk[key] === null) {
+                link.remove();
+            } else {
+                link.href = chunk[key];
+            }
+        });
+    }
+});
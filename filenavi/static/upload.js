@@ -1,10 +1,127 @@
 'use strict';
 
+const PARALLEL_CHUNKS = 4;
+const MAX_ATTEMPTS = 5;
+
+async function request(url, options = {}) {
+    let response = await fetch(url, {
+        credentials: 'same-origin',
+        headers: {'Accept': 'application/json'},
+        ...options,
+    });
+
+    if (!response.ok) {
+        let message = response.statusText;
+        try {
+            message = (await response.json()).error;
+        } catch (error) {}
+
+        let error = new Error(message);
+        error.status = response.status;
+        throw error;
+    }
+
+    return response;
+}
+
+async function retry(action) {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            return await action();
+        } catch (error) {
+            // Client errors will not go away by sending the same request again.
+            if (attempt >= MAX_ATTEMPTS || (error.status >= 400 && error.status < 500)) {
+                throw error;
+            }
+            await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt));
+        }
+    }
+}
+
+async function resume(key) {
+    let location = localStorage.getItem(key);
+    if (location === null) {
+        return null;
+    }
+
+    try {
+        let status = await (await request(location)).json();
+        status.location = location;
+        return status;
+    } catch (error) {
+        localStorage.removeItem(key);
+        return null;
+    }
+}
+
+async function uploadFile(endpoint, path, file, onProgress) {
+    let key = ['filenavi-upload', endpoint, path, file.name, file.size, file.lastModified].join(':');
+
+    let status = await resume(key);
+    if (status === null) {
+        let body = new URLSearchParams({path: path, name: file.name, size: file.size});
+        status = await (await retry(() => request(endpoint, {method: 'POST', body: body}))).json();
+        localStorage.setItem(key, status.location);
+    }
+
+    let received = new Set(status.received);
+    let pending = [];
+    for (let offset = 0; offset < file.size; offset += status.chunk_size) {
+        if (received.has(offset / status.chunk_size)) {
+            onProgress(Math.min(status.chunk_size, file.size - offset));
+        } else {
+            pending.push(offset);
+        }
+    }
+
+    let worker = async () => {
+        while (pending.length > 0) {
+            let offset = pending.shift();
+            let chunk = file.slice(offset, offset + status.chunk_size);
+            await retry(() => request(`${status.location}/${offset}`, {method: 'PUT', body: chunk}));
+            onProgress(chunk.size);
+        }
+    };
+    await Promise.all(Array.from({length: PARALLEL_CHUNKS}, worker));
+
+    let body = new URLSearchParams({replace: 'on'});
+    await retry(() => request(`${status.location}/finalize`, {method: 'POST', body: body}));
+    localStorage.removeItem(key);
+}
+
 document.addEventListener('DOMContentLoaded', () => {
     let form = document.querySelector('form.upload-files');
+    let input = form.querySelector('input[type="file"]');
+    let progress = form.querySelector('progress');
+    let message = form.querySelector('.upload-status');
 
     form.querySelector('button[type="submit"]').style.display = 'none';
-    form.querySelector('input[type="file"]').addEventListener('change', () => {
-        form.submit();
+    input.addEventListener('change', async () => {
+        if (!('fetch' in window) || form.dataset.uploads === undefined) {
+            form.submit();
+            return;
+        }
+
+        let files = Array.from(input.files);
+        let done = 0;
+        progress.max = files.reduce((total, file) => total + file.size, 0) || 1;
+        progress.value = 0;
+        progress.hidden = false;
+        input.disabled = true;
+        message.textContent = '';
+
+        try {
+            for (let file of files) {
+                await uploadFile(form.dataset.uploads, form.dataset.path, file, (size) => {
+                    done += size;
+                    progress.value = done;
+                });
+            }
+            window.location.reload();
+        } catch (error) {
+            message.textContent = `Upload failed: ${error.message}. Select the files again to resume.`;
+            input.disabled = false;
+            input.value = '';
+        }
     });
 });
@@ -0,0 +1,188 @@
+import os
+import sys
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, Future
+from multiprocessing import get_context
+from threading import Lock
+from time import time
+
+EXTENSIONS = ["png", "jpg", "jpeg", "gif"]
+SIZES = [128, 256, 512]
+FORMATS = {"jpg": "image/jpeg", "png": "image/png"}
+TOUCH_INTERVAL = 3600
+
+
+def interpreter() -> str:
+    # Servers that embed Python, like uWSGI, point sys.executable at their own
+    # binary, which processes cannot be spawned with.
+    if Path(sys.executable).name.startswith("python"):
+        return sys.executable
+    return str(Path(sys.prefix) / "bin" / "python3")
+
+
+def render(source: str, destination: str, size: int) -> str:
+    # This runs in the pool, so Pillow is only ever imported by its processes.
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        # JPEG images can be decoded at a fraction of their size right away.
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+
+        if image.mode in ["RGBA", "LA"] or "transparency" in image.info:
+            image = image.convert("RGBA")
+            extension, kind = "png", "PNG"
+        else:
+            image = image.convert("RGB")
+            extension, kind = "jpg", "JPEG"
+
+        path = f"{destination}.{extension}"
+        temporary = f"{path}.{os.getpid()}.part"
+        image.save(temporary, kind, optimize=True)
+        os.replace(temporary, path)
+
+    return path
+
+
+class ThumbnailCache:
+    def __init__(self):
+        self.directory = None
+        self.max_size = 0
+        self.workers = 0
+        self.context = None
+        self.executor = None
+        self.pending = {}
+        self.written = 0
+        self.lock = Lock()
+
+    def init_app(self, app):
+        self.workers = app.config.get("THUMBNAIL_WORKERS", 0)
+        self.max_size = app.config.get("THUMBNAIL_CACHE_SIZE", 0)
+        self.directory = app.config.get("THUMBNAIL_DIR") or (
+            Path(app.instance_path) / "thumbnails"
+        )
+
+        # Processes are spawned rather than forked, since the workers serving
+        # requests are threaded. The interpreter is set for the whole process,
+        # not just this context, which is why it is only done once.
+        if self.enabled and self.context is None:
+            self.context = get_context("spawn")
+            self.context.set_executable(interpreter())
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    @staticmethod
+    def key(path: Path, size: int) -> str:
+        # The key covers everything that changes the thumbnail, so a stale
+        # entry is never looked up again and simply ages out of the cache.
+        stat = path.stat()
+        data = f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0{size}"
+        return hashlib.sha256(os.fsencode(data)).hexdigest()
+
+    def lookup(self, key: str):
+        for extension, mimetype in FORMATS.items():
+            path = self.directory / key[:2] / f"{key}.{extension}"
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            # The modification time stands in for the access time, which is
+            # often not kept up to date by the file system.
+            if time() - mtime > TOUCH_INTERVAL:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    continue
+            return path, mimetype
+
+        return None
+
+    def get(self, path: Path, size: int) -> tuple:
+        key = self.key(path, size)
+        hit = self.lookup(key)
+        if hit is not None:
+            return hit
+
+        self.start()
+        # Concurrent requests for the same thumbnail wait for the same render
+        # instead of starting one each.
+        with self.lock:
+            future = self.pending.get(key)
+            submitted = future is None
+            if submitted:
+                future = self.pending[key] = self.submit(path, key, size)
+
+        try:
+            rendered = Path(future.result())
+        except Exception:
+            raise ValueError("Unable to render thumbnail")
+        finally:
+            if submitted:
+                with self.lock:
+                    self.pending.pop(key, None)
+
+        if submitted:
+            self.account(rendered.stat().st_size)
+        return rendered, FORMATS[rendered.suffix[1:]]
+
+    def start(self):
+        # The pool is started on first use rather than in init_app, so that
+        # it is never created in a process that forks into workers later.
+        if self.executor is not None:
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    self.workers, mp_context=self.context
+                )
+
+    def submit(self, path: Path, key: str, size: int) -> Future:
+        destination = self.directory / key[:2]
+        destination.mkdir(parents=True, exist_ok=True)
+        return self.executor.submit(render, str(path), str(destination / key), size)
+
+    def account(self, size: int):
+        # The whole cache is only measured once a good part of it could have
+        # been written since, as every worker writes to it.
+        with self.lock:
+            self.written += size
+            if self.written < self.max_size // 16:
+                return
+            self.written = 0
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return
+
+        # Entries are dropped down to a little below the limit, so that the
+        # next few renders do not trigger another pass right away.
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+cache = ThumbnailCache()
@@ -0,0 +1,217 @@
+import os
+import re
+import json
+import time
+import secrets
+from pathlib import Path
+from datetime import datetime, timezone
+from shutil import rmtree
+from threading import Thread, Lock
+
+TOKEN_PATTERN = re.compile(r"[0-9]+-[A-Za-z0-9_-]{16}")
+REAP_INTERVAL = 60
+
+
+def measure(path: Path) -> int:
+    if path.is_symlink() or not path.is_dir():
+        return path.lstat().st_size
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+class Entry:
+    def __init__(self, root: Path, token: str, state: dict):
+        self.root = root
+        self.token = token
+        self.visibility = state["visibility"]
+        self.path = state["path"]
+        self.removed = state["removed"]
+        self.size = state.get("size")
+
+    @property
+    def directory(self) -> Path:
+        return self.root / self.token
+
+    @property
+    def removal(self) -> datetime:
+        return datetime.fromtimestamp(self.removed, tz=timezone.utc)
+
+    @property
+    def data(self) -> Path:
+        return self.directory / "data"
+
+    def state(self) -> dict:
+        return {
+            "visibility": self.visibility,
+            "path": self.path,
+            "removed": self.removed,
+            "size": self.size,
+        }
+
+    def measure(self) -> int:
+        if self.size is None:
+            try:
+                self.size = measure(self.data)
+            except FileNotFoundError:
+                self.size = 0
+
+            temporary = self.directory / "state.json.part"
+            with open(temporary, "w") as f:
+                json.dump(self.state(), f)
+            os.replace(temporary, self.directory / "state.json")
+        return self.size
+
+    def restore(self, destination: Path):
+        if destination.exists() or destination.is_symlink():
+            raise FileExistsError("File already exists")
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(self.data, destination)
+        rmtree(self.directory, ignore_errors=True)
+
+    def purge(self) -> bool:
+        # The entry is claimed with a rename first, so that reapers running in
+        # other workers never purge the same entry at once.
+        doomed = self.root / f".purge-{self.token}"
+        try:
+            os.rename(self.directory, doomed)
+        except FileNotFoundError:
+            return False
+        rmtree(doomed, ignore_errors=True)
+        return True
+
+
+class Trash:
+    def __init__(self, root: Path):
+        self.root = root
+
+    def put(self, path: Path, visibility: str, relpath: str) -> Entry:
+        token = f"{time.time_ns()}-{secrets.token_urlsafe(12)}"
+        state = {"visibility": visibility, "path": relpath, "removed": time.time()}
+
+        entry = Entry(self.root, token, state)
+        entry.directory.mkdir(parents=True)
+        try:
+            with open(entry.directory / "state.json", "x") as f:
+                json.dump(state, f)
+            os.rename(path, entry.data)
+        except OSError:
+            rmtree(entry.directory, ignore_errors=True)
+            raise
+
+        return entry
+
+    def load(self, token: str) -> Entry:
+        if TOKEN_PATTERN.fullmatch(token) is None:
+            raise ValueError("Invalid trash entry")
+
+        try:
+            with open(self.root / token / "state.json") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            raise ValueError("No such trash entry")
+
+        return Entry(self.root, token, state)
+
+    def entries(self) -> list:
+        try:
+            it = os.scandir(self.root)
+        except FileNotFoundError:
+            return []
+
+        rv = []
+        with it:
+            for e in it:
+                if TOKEN_PATTERN.fullmatch(e.name) is None:
+                    continue
+                try:
+                    rv.append(self.load(e.name))
+                except (ValueError, OSError):
+                    continue
+        return sorted(rv, key=lambda e: e.removed)
+
+    def reap(self, max_age: float = None, max_size: int = None, purged=None):
+        for leftover in self.root.glob(".purge-*"):
+            rmtree(leftover, ignore_errors=True)
+
+        entries = self.entries()
+
+        if max_age is not None:
+            now = time.time()
+            for entry in [e for e in entries if now - e.removed > max_age]:
+                entry.measure()
+                if entry.purge() and purged is not None:
+                    purged(entry)
+                entries.remove(entry)
+
+        # Sizes are only measured here, in the background, so that moving an
+        # entry into the trash stays a single rename.
+        if max_size is not None:
+            total = sum(e.measure() for e in entries)
+            for entry in entries:
+                if total <= max_size:
+                    break
+                total -= entry.size
+                if entry.purge() and purged is not None:
+                    purged(entry)
+
+
+class Reaper:
+    def __init__(self):
+        self.app = None
+        self.purged = None
+        self.expire = None
+        self.thread = None
+        self.lock = Lock()
+
+    def init_app(self, app, purged=None, expire=None):
+        self.app = app
+        self.purged = purged
+        self.expire = expire
+        if app.config.get("TRASH", True) or expire is not None:
+            app.before_request(self.start)
+
+    def start(self):
+        # The thread is started by the first request rather than in init_app,
+        # so that it runs in every worker instead of a process that forks.
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self.run, name="filenavi-reaper", daemon=True
+                )
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.reap()
+            time.sleep(REAP_INTERVAL)
+
+    def reap(self):
+        users = self.app.config["DATA_DIR"] / self.app.config["USERS_DIR"]
+        with self.app.app_context():
+            if self.expire is not None:
+                try:
+                    self.expire(self.app.config["UPLOAD_MAX_AGE"])
+                except Exception:
+                    self.app.logger.exception("Unable to expire uploads")
+
+            if not self.app.config.get("TRASH", True):
+                return
+            for root in users.glob("*/trash"):
+                try:
+                    Trash(root).reap(
+                        self.app.config.get("TRASH_MAX_AGE"),
+                        self.app.config.get("TRASH_MAX_SIZE"),
+                        self.purged,
+                    )
+                except Exception:
+                    self.app.logger.exception("Unable to empty trash in %s", root)
+
+
+reaper = Reaper()
@@ -0,0 +1,318 @@
+import os
+import re
+import json
+import errno
+import time
+import secrets
+from pathlib import Path
+from shutil import rmtree, copyfile
+from tempfile import NamedTemporaryFile
+
+from flask import Request as BaseRequest
+
+from . import model, listing
+from .metrics import metrics
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_-]{16,64}")
+BLOCK_SIZE = 1024 * 1024
+
+
+def replaced_size(path: Path) -> int:
+    try:
+        return path.lstat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+class Request(BaseRequest):
+    stream_factory = None
+
+    def _get_file_stream(self, *args, **kwargs):
+        if self.stream_factory is not None:
+            return self.stream_factory(*args, **kwargs)
+        return super()._get_file_stream(*args, **kwargs)
+
+
+class DirectStreams:
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.pending = []
+
+    def __call__(self, total_content_length, content_type, filename, content_length=None):
+        # Each part is written to a hidden file next to its destination, with
+        # a buffer large enough that the parser's small reads turn into few
+        # large writes. Committing is then a rename on the same file system.
+        stream = NamedTemporaryFile(
+            "wb+",
+            buffering=BLOCK_SIZE,
+            dir=self.directory,
+            prefix=".filenavi-",
+            suffix=".part",
+            delete=False,
+        )
+        self.pending.append(stream)
+        return stream
+
+    def commit(self, storage, name: str) -> int:
+        if name in ["", ".", ".."] or Path(name).name != name:
+            raise ValueError("Invalid file name")
+
+        stream = storage.stream
+        if stream not in self.pending:
+            raise ValueError("Upload was not streamed to its destination")
+
+        stream.close()
+        size = os.stat(stream.name).st_size
+        replaced = replaced_size(self.directory / name)
+        os.replace(stream.name, self.directory / name)
+        self.pending.remove(stream)
+        metrics.uploaded(size)
+
+        return size - replaced
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for stream in self.pending:
+            stream.close()
+            Path(stream.name).unlink(missing_ok=True)
+        self.pending = []
+
+
+class Upload:
+    def __init__(self, owner: model.User, token: str, state: dict):
+        self.owner = owner
+        self.token = token
+        self.visibility = model.Visibility[state["visibility"]]
+        self.directory = Path(state["directory"])
+        self.name = state["name"]
+        self.size = state["size"]
+        self.chunk_size = state["chunk_size"]
+
+    @staticmethod
+    def root(owner: model.User) -> Path:
+        return owner.home() / "uploads"
+
+    @property
+    def staging(self) -> Path:
+        return self.root(self.owner) / self.token
+
+    @property
+    def chunks(self) -> int:
+        return -(-self.size // self.chunk_size)
+
+    @classmethod
+    def create(
+        cls,
+        owner: model.User,
+        visibility: model.Visibility,
+        directory: Path,
+        name: str,
+        size: int,
+        chunk_size: int,
+    ):
+        home = owner.home(visibility)
+        directory = owner.home(visibility, directory)
+
+        if not directory.is_relative_to(home):
+            raise ValueError("File must be within user directory")
+        if not directory.is_dir():
+            raise ValueError("Directory does not exist")
+        if name in ["", ".", ".."] or Path(name).name != name:
+            raise ValueError("Invalid file name")
+        if size < 0 or chunk_size <= 0:
+            raise ValueError("Invalid size")
+
+        state = {
+            "visibility": visibility.name,
+            "directory": str(directory.relative_to(home)),
+            "name": name,
+            "size": size,
+            "chunk_size": chunk_size,
+        }
+
+        token = secrets.token_urlsafe(24)
+        upload = cls(owner, token, state)
+        (upload.staging / "chunks").mkdir(parents=True)
+        with open(upload.staging / "state.json", "x") as f:
+            json.dump(state, f)
+        with open(upload.staging / "data", "xb") as f:
+            f.truncate(size)
+
+        # The declared size is counted right away, so that uploads that are
+        # still open count against the quota as well.
+        model.Usage.adjust(owner.id, visibility, size)
+        return upload
+
+    @classmethod
+    def load(cls, owner: model.User, token: str):
+        if TOKEN_PATTERN.fullmatch(token) is None:
+            raise ValueError("Invalid upload")
+
+        try:
+            with open(cls.root(owner) / token / "state.json") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            raise ValueError("No such upload")
+
+        return cls(owner, token, state)
+
+    @classmethod
+    def pending(cls, owner: model.User) -> list:
+        try:
+            it = os.scandir(cls.root(owner))
+        except FileNotFoundError:
+            return []
+
+        rv = []
+        with it:
+            for e in it:
+                if TOKEN_PATTERN.fullmatch(e.name) is None:
+                    continue
+                try:
+                    rv.append(cls.load(owner, e.name))
+                except (ValueError, OSError):
+                    continue
+        return rv
+
+    @classmethod
+    def reap(cls, max_age: float):
+        for owner in model.User.query.all():
+            for pattern in [".abort-*", ".finalize-*"]:
+                for leftover in cls.root(owner).glob(pattern):
+                    rmtree(leftover, ignore_errors=True)
+            for upload in cls.pending(owner):
+                if upload.idle() > max_age:
+                    try:
+                        upload.abort()
+                    except ValueError:
+                        continue
+
+    @property
+    def target(self) -> model.File:
+        return model.File(self.directory / self.name, self.owner, self.visibility)
+
+    def received(self) -> list:
+        # Uploads can be finalized or aborted by another request at any time,
+        # after which their staging directory is gone.
+        try:
+            return sorted(int(p.name) for p in (self.staging / "chunks").iterdir())
+        except FileNotFoundError:
+            raise ValueError("No such upload")
+
+    def offset(self, received=None) -> int:
+        received = self.received() if received is None else received
+        count = 0
+        while count < len(received) and received[count] == count:
+            count += 1
+        return min(count * self.chunk_size, self.size)
+
+    def idle(self) -> float:
+        # Chunks are written into the data file, so its modification time is
+        # that of the last activity.
+        latest = 0
+        for path in [self.staging, self.staging / "data"]:
+            try:
+                latest = max(latest, path.stat().st_mtime)
+            except FileNotFoundError:
+                continue
+        return time.time() - latest
+
+    def measure(self) -> int:
+        return self.size
+
+    def status(self) -> dict:
+        received = self.received()
+        return {
+            "token": self.token,
+            "name": self.name,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "received": received,
+            "offset": self.offset(received),
+        }
+
+    def write(self, offset: int, stream, length: int):
+        if offset < 0 or offset % self.chunk_size != 0 or offset >= self.size:
+            raise ValueError("Invalid offset")
+        if length != min(self.chunk_size, self.size - offset):
+            raise ValueError("Invalid chunk length")
+
+        # Chunks are written in place with pwrite so that several of them can
+        # be in flight at once, possibly in different workers. A chunk only
+        # counts as received once its marker exists.
+        try:
+            fd = os.open(self.staging / "data", os.O_WRONLY)
+        except FileNotFoundError:
+            raise ValueError("No such upload")
+        try:
+            position = offset
+            while position < offset + length:
+                block = stream.read(min(BLOCK_SIZE, offset + length - position))
+                if not block:
+                    raise ValueError("Incomplete chunk")
+                position += os.pwrite(fd, block, position)
+        finally:
+            os.close(fd)
+        metrics.uploaded(length)
+
+        try:
+            (self.staging / "chunks" / str(offset // self.chunk_size)).touch()
+        except FileNotFoundError:
+            raise ValueError("No such upload")
+
+    def finalize(self, force: bool = False) -> model.File:
+        if len(self.received()) != self.chunks:
+            raise ValueError("Upload is incomplete")
+
+        target = self.target
+        if not target.path.is_relative_to(self.owner.home(self.visibility)):
+            raise ValueError("File must be within user directory")
+        if target.path.is_dir() and not target.path.is_symlink():
+            raise FileExistsError("A directory with that name already exists")
+        if target.path.exists() and not force:
+            raise FileExistsError("File already exists")
+
+        # Like aborting, finalizing claims the upload with a rename first, so
+        # that only one of them ever goes through.
+        staging = self.claim("finalize")
+        replaced = replaced_size(target.path)
+        try:
+            os.replace(staging / "data", target.path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                # The upload is handed back, so it can be finalized again or
+                # expires like any other.
+                os.rename(staging, self.staging)
+                raise ValueError("Unable to finalize upload")
+            # The destination is on another file system, so the data is
+            # copied next to it first to keep the final rename atomic.
+            temporary = target.path.with_name(f".{self.token}.filenavi-part")
+            copyfile(staging / "data", temporary)
+            os.replace(temporary, target.path)
+        rmtree(staging, ignore_errors=True)
+
+        model.Usage.adjust(self.owner.id, self.visibility, -replaced)
+        model.IndexEntry.add(
+            self.owner.id,
+            self.visibility,
+            self.owner.home(self.visibility),
+            target.path,
+        )
+        listing.cache.invalidate(self.owner, self.visibility, self.directory)
+        return target
+
+    def claim(self, action: str) -> Path:
+        claimed = self.root(self.owner) / f".{action}-{self.token}"
+        try:
+            os.rename(self.staging, claimed)
+        except FileNotFoundError:
+            raise ValueError("No such upload")
+        return claimed
+
+    def abort(self):
+        # The upload is claimed with a rename first, so that its reservation
+        # is only released once when workers expire it at the same time.
+        rmtree(self.claim("abort"), ignore_errors=True)
+        model.Usage.adjust(self.owner.id, self.visibility, -self.size)
@@ -0,0 +1,186 @@
+from collections import OrderedDict
+from threading import Thread, Lock
+from time import monotonic, sleep
+import json
+
+from redis.exceptions import RedisError
+
+CHANNEL = "filenavi:users"
+
+
+class MemoryBackend:
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            hit = self.entries.get(key)
+            if hit is None:
+                return None
+            if hit[0] < monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return hit[1]
+
+    def set(self, key: str, value):
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, *keys: str):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class Broadcast:
+    # Every worker has a memory cache of its own, so invalidations are sent
+    # to all of them through Redis. Entries are only trusted while the
+    # subscription is up, as invalidations sent in the meantime are lost.
+    def __init__(self, app, backend: MemoryBackend, redis):
+        self.app = app
+        self.backend = backend
+        self.redis = redis
+        self.subscribed = False
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        # Like the event bus, the subscriber is started by the first request
+        # so that it runs in every worker.
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self.run, name="filenavi-users", daemon=True
+                )
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(CHANNEL)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        self.backend.clear()
+                        self.subscribed = True
+                    elif message["type"] == "message":
+                        self.backend.delete(*json.loads(message["data"]))
+            except Exception:
+                self.subscribed = False
+                self.app.logger.exception("Lost the user cache subscription")
+                sleep(1)
+
+    def get(self, key: str):
+        if not self.subscribed:
+            return None
+        return self.backend.get(key)
+
+    def set(self, key: str, value):
+        if self.subscribed:
+            self.backend.set(key, value)
+
+    def delete(self, *keys: str):
+        self.backend.delete(*keys)
+        self.redis.publish(CHANNEL, json.dumps(keys))
+
+
+class RedisBackend:
+    prefix = "filenavi:user:"
+
+    def __init__(self, redis, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+
+    def get(self, key: str):
+        value = self.redis.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value):
+        self.redis.setex(self.prefix + key, self.ttl, json.dumps(value))
+
+    def delete(self, *keys: str):
+        self.redis.delete(*(self.prefix + k for k in keys))
+
+
+class UserCache:
+    def __init__(self):
+        self.app = None
+        self.backend = None
+
+    def init_app(self, app):
+        self.app = app
+        kind = app.config.get("USER_CACHE")
+        ttl = app.config.get("USER_CACHE_TTL", 60)
+
+        if kind is None:
+            return
+        if kind not in ["memory", "redis"]:
+            raise ValueError("Invalid user cache backend")
+
+        redis = app.config.get("SESSION_REDIS")
+        if redis is None:
+            from redis import Redis
+
+            redis = Redis()
+
+        if kind == "memory":
+            self.backend = Broadcast(
+                app,
+                MemoryBackend(app.config.get("USER_CACHE_SIZE", 1024), ttl),
+                redis,
+            )
+            app.before_request(self.backend.start)
+        else:
+            self.backend = RedisBackend(redis, ttl)
+
+    def get(self, id: int = None, name: str = None):
+        if self.backend is None:
+            return None
+
+        if id is None:
+            id = self.backend.get(f"name:{name}")
+            if id is None:
+                return None
+
+        values = self.backend.get(f"id:{id}")
+        # The name index is not invalidated on every rename, so it is only
+        # trusted if the record it points at still carries the same name.
+        if values is None or (name is not None and values["name"] != name):
+            return None
+        return values
+
+    def set(self, values: dict):
+        if self.backend is None:
+            return
+
+        self.backend.set(f"id:{values['id']}", values)
+        self.backend.set(f"name:{values['name']}", values["id"])
+
+    def invalidate(self, id: int, *names: str):
+        if self.backend is None:
+            return
+
+        # This runs after the change was committed, and entries expire on
+        # their own anyway, so an unreachable Redis does not fail the request.
+        try:
+            self.backend.delete(f"id:{id}", *(f"name:{n}" for n in names))
+        except RedisError:
+            self.app.logger.exception("Unable to invalidate cached user %d", id)
+
+
+cache = UserCache()
@@ -0,0 +1,232 @@
+import os
+import re
+import errno
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+
+from flask import current_app
+
+from . import model
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+HEADER = struct.Struct("iIII")
+BUFFER_SIZE = 64 * 1024
+# The hidden files uploads and moves are written to before they are renamed
+# into place, which is reported on its own.
+TEMPORARY_PATTERN = re.compile(r"\.filenavi-.*\.part|\..*\.filenavi-part")
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Unable to initialize inotify")
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), str(path))
+        return wd
+
+    def rm_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> list:
+        data = os.read(self.fd, BUFFER_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    def __init__(self, root: Path, publish):
+        self.root = root
+        self.publish = publish
+        self.visibilities = {str(v): v for v in model.Visibility}
+        self.inotify = Inotify()
+        self.watches = {}
+        self.paths = {}
+        self.stale = set()
+
+    def locate(self, path: Path):
+        # Returns the user, the visibility and the path relative to its home,
+        # or None for anything outside of the public and private homes.
+        parts = path.relative_to(self.root).parts
+        if len(parts) < 2 or not parts[0].isdigit():
+            return None
+        if parts[1] not in self.visibilities:
+            return None
+        return int(parts[0]), self.visibilities[parts[1]], Path(*parts[2:])
+
+    def homes(self):
+        for d in self.root.iterdir():
+            if d.name.isdigit():
+                for visibility in self.visibilities.values():
+                    yield int(d.name), visibility
+
+    def affected(self, events: list) -> set:
+        rv = set()
+        for wd, mask, cookie, name in events:
+            directory = self.watches.get(wd)
+            location = None if directory is None else self.locate(directory / name)
+            if location is not None:
+                rv.add(location[:2])
+        return rv
+
+    def watchable(self, path: Path) -> bool:
+        if path == self.root:
+            return True
+        parts = path.relative_to(self.root).parts
+        return parts[0].isdigit() and (len(parts) == 1 or self.locate(path) is not None)
+
+    def watch(self, path: Path):
+        # Directories are watched before they are listed, so that nothing
+        # created in between goes unnoticed.
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            if not self.watchable(directory):
+                continue
+            try:
+                wd = self.inotify.add_watch(directory, MASK)
+            except OSError as e:
+                if e.errno in [errno.ENOENT, errno.ENOTDIR, errno.EACCES]:
+                    continue
+                raise
+            self.watches[wd] = directory
+            self.paths[directory] = wd
+
+            try:
+                it = os.scandir(directory)
+            except OSError:
+                continue
+            with it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(Path(e.path))
+
+    def unwatch(self, path: Path):
+        for p in [p for p in self.paths if p == path or path in p.parents]:
+            wd = self.paths.pop(p)
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def changed(self, path: Path, is_dir: bool, exists: bool, changes: dict):
+        location = self.locate(path)
+        if location is None:
+            return
+        user_id, visibility, relpath = location
+        if relpath == Path("."):
+            return
+
+        home = self.root / str(user_id) / str(visibility)
+        if exists:
+            model.IndexEntry.add(user_id, visibility, home, path)
+        else:
+            model.IndexEntry.discard(user_id, visibility, relpath.as_posix())
+
+        parent = (user_id, visibility.name, relpath.parent.as_posix())
+        changes[parent] = changes.get(parent, False)
+        if is_dir:
+            changes[user_id, visibility.name, relpath.as_posix()] = True
+
+    def handle(self, events: list) -> list:
+        changes = {}
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so every cache has to be dropped, new
+                # directories may not be watched yet and the index of every
+                # user has to be compared with their files again.
+                self.watch(self.root)
+                self.stale.update(self.homes())
+                return [{"reset": True}]
+            if mask & IN_IGNORED:
+                path = self.watches.pop(wd, None)
+                if path is not None:
+                    self.paths.pop(path, None)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None or not name or TEMPORARY_PATTERN.fullmatch(name):
+                continue
+
+            path = directory / name
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if is_dir:
+                    self.watch(path)
+                self.changed(path, is_dir, True, changes)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if is_dir:
+                    self.unwatch(path)
+                self.changed(path, is_dir, False, changes)
+            elif mask & IN_CLOSE_WRITE:
+                self.changed(path, False, True, changes)
+
+        return [
+            {"user": user_id, "visibility": visibility, "path": path, "recursive": r}
+            for (user_id, visibility, path), r in changes.items()
+        ]
+
+    def run(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.watch(self.root)
+        while True:
+            batch = self.inotify.read()
+            try:
+                events = self.handle(batch)
+            except Exception:
+                model.db.session.rollback()
+                current_app.logger.exception("Unable to handle changes")
+                self.stale.update(self.affected(batch))
+                events = [{"reset": True}]
+            if events:
+                self.publish(events)
+            self.reindex()
+
+    def reindex(self):
+        while self.stale:
+            user_id, visibility = self.stale.pop()
+            user = model.User.query.get(user_id)
+            if user is None:
+                continue
+            try:
+                model.IndexEntry.apply(model.IndexEntry.rebuild, user, visibility)
+            except Exception:
+                model.db.session.rollback()
+                current_app.logger.exception("Unable to index files of %d", user_id)
@@ -0,0 +1,37 @@
+import pytest
+
+from filenavi import create_app, model
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # The configuration is only read from /etc/filenavi or the working
+    # directory.
+    (tmp_path / "config.ini").write_text(
+        "[filenavi]\n"
+        f"database_uri=sqlite:///{tmp_path / 'filenavi.db'}\n"
+        f"data_dir={tmp_path / 'data'}\n"
+        "session=cookie\n"
+        "secret_key=test\n"
+        "password_method=pbkdf2:sha256:1000\n"
+    )
+    monkeypatch.chdir(tmp_path)
+
+    app = create_app({"TESTING": True})
+    with app.app_context():
+        model.db.create_all()
+        model.db.session.add(model.User("owner", "owner", model.Rank.OWNER))
+        model.db.session.add(model.User("user", "user", model.Rank.USER))
+        model.db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        model.db.session.remove()
+        model.db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
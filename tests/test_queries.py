@@ -0,0 +1,164 @@
+import io
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from filenavi import model
+
+# Every storage route with a request that reaches its view; the files and
+# sessions they refer to are set up by prepare.
+ROUTES = [
+    ("storage.browse", "GET", "/owner/private/browse/", None),
+    ("storage.browse", "GET", "/owner/private/browse/a.txt", None),
+    ("storage.preview_text", "GET", "/owner/private/preview/a.txt", None),
+    ("storage.thumbnail_download", "GET", "/owner/private/thumbnail/a.png", None),
+    ("storage.listing_events", "GET", "/owner/private/events/", None),
+    ("storage.search", "GET", "/owner/private/search?q=txt", None),
+    ("storage.directories", "GET", "/owner/private/directories?prefix=d", None),
+    ("storage.archive_download", "GET", "/owner/private/archive/directory", None),
+    ("storage.browse_handler", "POST", "/owner/private/browse/", "upload"),
+    ("storage.move", "GET", "/owner/private/move/a.txt", None),
+    ("storage.move_handler", "POST", "/owner/private/move/a.txt", "move"),
+    ("storage.toggle", "GET", "/owner/private/toggle/a.txt", None),
+    ("storage.toggle_handler", "POST", "/owner/private/toggle/a.txt", "toggle"),
+    ("storage.remove", "GET", "/owner/private/remove/a.txt", None),
+    ("storage.remove_handler", "POST", "/owner/private/remove/a.txt", {}),
+    ("storage.batch_handler", "POST", "/owner/private/batch/", "batch"),
+    ("storage.trash", "GET", "/owner/trash/", None),
+    ("storage.trash_restore", "POST", "/owner/trash/{trash}/restore", {}),
+    ("storage.trash_purge", "POST", "/owner/trash/{trash}/purge", {}),
+    ("storage.job_listing", "GET", "/owner/jobs/", None),
+    ("storage.job_status", "GET", "/owner/jobs/1", None),
+    ("storage.upload_create", "POST", "/owner/private/uploads/", "create"),
+    ("storage.upload_status", "GET", "/owner/private/uploads/{upload}", None),
+    ("storage.upload_chunk", "PUT", "/owner/private/uploads/{upload}/0", b"x"),
+    (
+        "storage.upload_finalize",
+        "POST",
+        "/owner/private/uploads/{upload}/finalize",
+        {},
+    ),
+    ("storage.upload_abort", "DELETE", "/owner/private/uploads/{upload}", None),
+]
+
+FORMS = {
+    "move": lambda: {"path": "directory/a.txt"},
+    "toggle": lambda: {"path": "a.txt"},
+    "batch": lambda: {"action": "move", "paths": ["b.txt"], "destination": "c"},
+    "create": lambda: {"path": "", "name": "c.txt", "size": "1"},
+    "upload": lambda: {"files": [(io.BytesIO(b"data"), "d.txt")]},
+}
+
+
+def login(client, name):
+    rv = client.post("/login", data={"name": name, "password": name})
+    assert rv.status_code == 302
+
+
+def prepare(client) -> dict:
+    login(client, "owner")
+    home = model.User.query.filter_by(name="owner").one().home(
+        model.Visibility.PRIVATE
+    )
+    (home / "directory").mkdir(parents=True)
+    for name in ["a.txt", "b.txt", "trashed.txt", "directory/e.txt"]:
+        (home / name).write_text("text")
+
+    rv = client.post("/owner/private/remove/trashed.txt")
+    assert rv.status_code == 302
+    rv = client.post(
+        "/owner/private/uploads/",
+        data={"path": "", "name": "upload.txt", "size": "1"},
+    )
+    assert rv.status_code == 201
+
+    owner = model.User.query.filter_by(name="owner").one()
+    return {
+        "trash": owner.trash().entries()[0].token,
+        "upload": rv.get_json()["token"],
+    }
+
+
+@contextmanager
+def counting(engine):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, many):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def user_queries(statements: list) -> int:
+    return sum("FROM users" in s for s in statements)
+
+
+def test_every_storage_route_is_covered(app):
+    endpoints = {r.endpoint for r in app.url_map.iter_rules()}
+    endpoints = {e for e in endpoints if e.startswith("storage.")}
+    assert endpoints == {endpoint for endpoint, *_ in ROUTES}
+
+
+@pytest.mark.parametrize(
+    "endpoint, method, url, data", ROUTES, ids=[f"{r[0]}-{r[2]}" for r in ROUTES]
+)
+def test_storage_route_queries_users_once(app, client, endpoint, method, url, data):
+    # Requests reuse an application context that is already pushed, along
+    # with the users memoized on it, so none is left open while they run.
+    with app.app_context():
+        url = url.format(**prepare(client))
+        engine = model.db.engine
+    if isinstance(data, str):
+        data = FORMS[data]()
+
+    with counting(engine) as statements:
+        rv = client.open(url, method=method, data=data)
+        rv.close()
+
+    assert rv.status_code < 500
+    assert user_queries(statements) == 1
+
+
+# Public files are served without looking at the session, so only the owner
+# from the URL is queried.
+PUBLIC = [
+    ("owner", "/owner/public/browse/f.txt", 200, 1),
+    ("owner", "/owner/public/browse/", 200, 1),
+    (None, "/owner/public/browse/f.txt", 200, 1),
+    (None, "/owner/public/browse/", 302, 1),
+    ("user", "/owner/public/browse/f.txt", 200, 1),
+]
+
+
+@pytest.mark.parametrize("name, url, status, queries", PUBLIC)
+def test_public_browse_queries(app, client, name, url, status, queries):
+    with app.app_context():
+        owner = model.User.query.filter_by(name="owner").one()
+        (owner.home(model.Visibility.PUBLIC) / "f.txt").write_text("text")
+        engine = model.db.engine
+    if name is not None:
+        login(client, name)
+
+    with counting(engine) as statements:
+        rv = client.get(url)
+        rv.close()
+
+    assert rv.status_code == status
+    assert user_queries(statements) == queries
+
+
+def test_other_user_is_queried_once(app, client):
+    login(client, "owner")
+    with app.app_context():
+        engine = model.db.engine
+
+    with counting(engine) as statements:
+        rv = client.get("/user/private/browse/")
+
+    assert rv.status_code == 200
+    assert user_queries(statements) == 2